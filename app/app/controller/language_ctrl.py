@@ -300,7 +300,7 @@ async def get_history(
         data: UserGuideMappingFormat, sw: ServiceWorker = Depends(get_sw)
 ):
     sw.request.app.state.user_guides_mapping = data
-    JSONPath(join(BASE_LANGUAGE_DIR, "user_guides_mapping.json")).write(
+    JSONPath.for_write(join(BASE_LANGUAGE_DIR, "user_guides_mapping.json")).write(
         data.dict(), pretty=True
     )
     return sw.msg_response("entry.updated")
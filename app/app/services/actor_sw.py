@@ -58,7 +58,7 @@ from app.util.consts import (
 from app.util.emails import send_new_account_email
 from app.util.exceptions import ApplicationException
 from app.util.files import read_orjson
-from app.util.passwords import verify_hash, create_hash
+from app.util.passwords import verify_hash, verify_login_hash, create_hash
 
 logger = getLogger(__name__)
 
@@ -270,7 +270,7 @@ class ActorService:
         if self.is_oauth_user(db_actor):
             verified = True
         else:
-            verified = verify_hash(credentials.password.get_secret_value(), db_actor.hashed_password)
+            verified = verify_login_hash(credentials.password.get_secret_value(), db_actor.hashed_password)
         if not verified:
             raise ApplicationException(
                 status_code=HTTP_403_FORBIDDEN, msg="Incorrect username or password"
@@ -91,7 +91,7 @@ class CodeService:
             icons = set()
             if code_schema == "value_tree":
                 tree = code_entry.values["root"]
-                recursive_transform(tree, get_icon, icons=icons)
+                recursive_transform(tree, get_icon, copy_root=False, icons=icons)
             elif code_schema == "value_list":
                 list_ = code_entry.values["list"]
                 icons = set(item["icon"] for item in list_ if item.get("icon"))
@@ -29,6 +29,7 @@ from app.setup.static_fe_dir import add_static_fe_dir, add_domain_redirect_pages
 from app.setup.tests import clear_db
 from app.util.consts import NO_DOMAIN
 from app.util.db_util import commit_and_new
+from app.util.emails import close_smtp
 from app.util.exceptions import (
     ApplicationException,
     application_exception_handler,
@@ -51,6 +52,7 @@ def setup_all(app: FastAPI):
 
     app.add_exception_handler(ApplicationException, application_exception_handler)
     app.add_exception_handler(Exception, exception_handler)
+    app.add_event_handler("shutdown", close_smtp)
 
     app.include_router(controller.base_router)
 
@@ -1,3 +1,4 @@
+from itertools import chain
 from logging import getLogger
 from os import listdir, makedirs
 from os.path import isdir, join, exists
@@ -48,14 +49,15 @@ def remove_redundant_actor_folders(sw: ServiceWorker) -> List[str]:
     @return: registered names of removed actors
     """
     all_actors_folder = listdir(settings.USER_DATA_FOLDER)
+    get_actor_path = sw.actor.get_actor_path
     for actor in sw.db_session.query(RegisteredActor):
-        actor_path = sw.actor.get_actor_path(actor.registered_name)
+        actor_path = get_actor_path(actor.registered_name)
         if isdir(actor_path):
             all_actors_folder.remove(actor.registered_name)
     # existing_actor_folder.remove()
     logger.debug(f"removing actor folder for: {all_actors_folder}")
     for redundant_actor_folder in all_actors_folder:
-        rmtree(sw.actor.get_actor_path(redundant_actor_folder))
+        rmtree(get_actor_path(redundant_actor_folder))
     return all_actors_folder
 
 
@@ -86,10 +88,11 @@ def remove_redundant_entry_folders(sw: ServiceWorker):
                 by_slug.remove(slug_)
         elif (uuid_ := db_e.uuid) in by_uuid:
             by_uuid.remove(uuid_)
-    for folder in by_uuid + by_slug:
-        logger.debug(f"removing entry-folder: {folder}")
-        if isdir(folder):
-            rmtree(folder)
+    for folder in chain(by_uuid, by_slug):
+        folder_path = join(settings.ENTRY_DATA_FOLDER, folder)
+        if isdir(folder_path):
+            logger.debug(f"removing entry-folder: {folder_path}")
+            rmtree(folder_path)
 
 
 def visitor_avatar():
@@ -1,3 +1,4 @@
+import sys
 from datetime import date
 from re import match
 from typing import Any, Callable, List, Union, Set
@@ -6,6 +7,9 @@ from uuid import uuid4
 import Levenshtein
 import base58
 
+# slots for dataclasses with many instances, dataclass supports them from python 3.10 on
+DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
 
 def replace_value(
     data: dict, loc: List[Union[str, int]], func: Callable[[Any], Any]
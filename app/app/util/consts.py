@@ -181,9 +181,9 @@ aspect_types = {
     MONTH
 }
 
-SELECT_TYPES = {
+SELECT_TYPES = frozenset({
     SELECT, MULTISELECT, TREE, TREEMULTISELECT
-}
+})
 
 TERMINAL_ASPECT_TYPES = [t for t in aspect_types if t not in [COMPOSITE, LIST]]
 
@@ -1,5 +1,4 @@
 from csv import DictWriter
-from datetime import datetime
 from typing import List
 
 from app.models.orm import Entry
@@ -48,8 +47,8 @@ inner_value_sep = ":"
 
 transformer = {
     "uuid": lambda uuid: str(uuid),
-    "creation_ts": lambda ts: datetime.strftime(ts, "%Y"),
-    "last_edit_ts": lambda ts: datetime.strftime(ts, "%Y"),
+    "creation_ts": lambda ts: str(ts.year),
+    "last_edit_ts": lambda ts: str(ts.year),
     "template": lambda template: template.title,
     "actors": lambda actors: cell_separated(
         list(map(lambda entry_role: entry_role.csv_format(inner_value_sep), actors))
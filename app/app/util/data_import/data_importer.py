@@ -1,27 +1,38 @@
 import sys
+from collections import defaultdict
 from logging import getLogger
-from typing import List, Tuple, Optional, Any, Dict, Set, Iterable, Union, Callable, Sequence
+from typing import List, Tuple, Optional, Any, Dict, Iterable, Union, Callable, Sequence
 from urllib.parse import urljoin
 
+import orjson
 from colorama import Fore
 
 from app.models.orm import Entry, EntryEntryAssociation
 from app.models.schema import EntryRef, TemplateMerge
-from app.models.schema.entry_schemas import EntryRegular, EntryOut
+from app.models.schema.entry_schemas import EntryRegular
 from app.models.schema.template_code_entry_schema import EntryEntryRef
 from app.services.util.aspect import aspect_default, pack_raw_value
 from app.services.service_worker import ServiceWorker
-from app.util.consts import REGISTERED_NAME, CREATOR, ACTOR, LIST, VALUE, \
-    SELECT, TREE, MULTISELECT, TREEMULTISELECT, SELECT_TYPES, TEXT, TEMPLATE, VALUE_TREE, SLUG, STATUS, TAGS, \
+from app.util.consts import REGISTERED_NAME, CREATOR, ACTOR, VALUE, \
+    MULTISELECT, SELECT_TYPES, TEXT, TEMPLATE, VALUE_TREE, SLUG, STATUS, TAGS, \
     TEMPLATE_VERSION
 from app.util.data_import.models import MappingAspectOutput, ItemError, RowError, Mapping, SelectValues, \
-    ExceptionalValue, MappingValueInput, AspectMappingDefinitionExceptionalValue
+    ExceptionalValue, AspectMappingDefinitionExceptionalValue, \
+    TERMINAL_SCALAR, TERMINAL_SELECT, TERMINAL_MULTISELECT, TERMINAL_LIST_SELECT
 from app.util.data_import.validate import validate_mapping
+from app.util.dict_rearrange import delete_none
 from app.util.files import CSVPath
-from app.util.tree_funcs import find_by
+from app.util.tree_funcs import find_by, build_find_index
 
 logger = getLogger(__name__)
 
+# buffer size for reading the import tables. the header and all rows are read through the same reader
+IMPORT_TABLE_BUFFER_SIZE = 1 << 20
+
+# fields of the reference entries, that are not part of a TemplateMerge
+TEMPLATE_MERGE_STRIP_FIELDS = frozenset({"creation_ts", "last_edit_ts", STATUS, TAGS, TEMPLATE_VERSION,
+                                         "attached_files"})
+
 
 def create_regular(template: TemplateMerge, sw: ServiceWorker, username: str) -> EntryRegular:
     return sw.entry.create_empty_regular(
@@ -47,15 +58,14 @@ def get_prepare_templates_and_references(client, api_base_url: str, slug: str, l
     })
 
     def to_template_merge(entry_data: dict):
-        conv_data = EntryOut.parse_obj(entry_data).dict(exclude_none=True)
-        for field in ["creation_ts", "last_edit_ts", STATUS, TAGS, TEMPLATE_VERSION, "attached_files"]:
-            if field in conv_data:
-                del conv_data[field]
-        return TemplateMerge(**conv_data)
+        # validated once, directly as TemplateMerge, instead of EntryOut -> dict -> TemplateMerge
+        # None values are removed in the nested dicts as well, like exclude_none did
+        conv_data = delete_none({k: v for k, v in entry_data.items() if k not in TEMPLATE_MERGE_STRIP_FIELDS})
+        return TemplateMerge.parse_obj(conv_data)
 
     if entries_respones.status_code == 200:
         return {
-            entry_data[SLUG]: to_template_merge(entry_data) for entry_data in entries_respones.json()
+            entry_data[SLUG]: to_template_merge(entry_data) for entry_data in orjson.loads(entries_respones.content)
         }
     else:
         print(f"Failed to get template merge for {slug}/{language} from {entries_respones.url}")
@@ -64,98 +74,139 @@ def get_prepare_templates_and_references(client, api_base_url: str, slug: str, l
 def import_tables(table_paths: List[CSVPath], template_model: TemplateMerge, value_mapping: Mapping,
                   sw: ServiceWorker, username: str, ignore_columns: Sequence[str] = (),
                   ref_entries: Dict[str, TemplateMerge] = {},
-                  post_creation_script: Optional[Callable[[Dict[int, EntryRegular]], None]] = None) -> List[
-    EntryRegular]:
+                  post_creation_script: Optional[Callable[[Dict[int, EntryRegular]], None]] = None) -> \
+        List[EntryRegular]:
     """
     take some tables and create regular entries from them. The mapping provides
     a mapping from a column to a value location (jsonpath)
     List of simple values can be comma separated, of composites must be split into multiple columns
     The first column of all tables must be an id, which can be used for composite-lists
     ! when a non composite list value appears twice an error occurs
+    post_creation_script gets an id -> entry dict of all created entries
     """
     if template_model.type != TEMPLATE:
         raise ValueError("Only entries of type templates can be used for imports")
 
     # template_model = TemplateMerge.from_orm(template)
-    readers = [table_path.read(as_dict=True) for table_path in table_paths]
+    readers = [table_path.read(buffering=IMPORT_TABLE_BUFFER_SIZE) for table_path in table_paths]
+    headers = [next(reader) for reader in readers]
 
     # validation
     try:
-        mapping: Dict[MappingValueInput, MappingAspectOutput]
+        mapping: Dict[str, MappingAspectOutput]
         id_field: str
         mapping, id_field = validate_mapping(template_model,
-                                             zip(table_paths, readers),
+                                             zip(table_paths, headers),
                                              value_mapping, ignore_columns)
 
     except ValueError as err:
         print(err)
         raise
 
-    load_and_assign_code_entries(template_model, list(mapping.values()), ref_entries)
-    id_entry_map: dict[int, EntryRegular] = {}
+    load_and_assign_code_entries(template_model, mapping.values(), ref_entries)
+    tables: List[Tuple[CSVPath, List[Tuple[int, MappingAspectOutput]], List[List[str]], List[Optional[int]]]] = []
+    for table_path, reader, header in zip(table_paths, readers, headers):
+        # headers are the same for all rows, so strip and match them only once
+        column_indices = {name.strip(): index for index, name in enumerate(header)}
+        mapped_columns: List[Tuple[int, MappingAspectOutput]] = [
+            (index, mapping[name]) for name, index in column_indices.items() if name in mapping]
+        num_columns = len(header)
+        # empty lines are skipped, like the DictReader does
+        rows = list(filter(None, reader))
+        for row in rows:
+            if len(row) < num_columns:
+                row += [""] * (num_columns - len(row))
+        row_ids = parse_row_ids(rows, column_indices[id_field])
+        if num_invalid_ids := row_ids.count(None):
+            logger.warning(f"{table_path.name}: {num_invalid_ids} rows with an id not of type integer")
+        tables.append((table_path, mapped_columns, rows, row_ids))
+
+    # dense ids (the usual running numbers) index a list, sparse ones a dict
+    valid_ids = [row_id for table in tables for row_id in table[3] if row_id is not None]
+    dense_ids = bool(valid_ids) and min(valid_ids) >= 0 and max(valid_ids) < 2 * len(valid_ids)
+    entries: Union[List[Optional[EntryRegular]], Dict[int, EntryRegular]]
+    if dense_ids:
+        entries = [None] * (max(valid_ids) + 1)
+        get_entry = entries.__getitem__
+    else:
+        entries = {}
+        get_entry = entries.get
+
+    # ids in the order of their first appearance, which is the order of the returned entries
+    created_ids: List[int] = []
     all_errors = []
-    for table_path, reader in zip(table_paths, readers):
-        for row_index, row in enumerate(reader):
-            # print(row)
-            try:
-                row_id = int(row[id_field])
-                # print(id)
-            except ValueError:
-                logger.warning("id not of type integer")
-            else:
-                if row_id in id_entry_map:
-                    entry = id_entry_map[row_id]
-                else:
-                    entry = create_regular(template_model, sw, username)
-                    id_entry_map[row_id] = entry
-                errors = read_row(row, entry, mapping)
+    for table_path, mapped_columns, rows, row_ids in tables:
+        for row_index, (row, row_id) in enumerate(zip(rows, row_ids)):
+            if row_id is None:
+                continue
+            if (entry := get_entry(row_id)) is None:
+                entry = create_regular(template_model, sw, username)
+                entries[row_id] = entry
+                created_ids.append(row_id)
+            if errors := read_row(row, entry, mapped_columns):
                 all_errors.append(
                     RowError(document_name=table_path.name, row_id=row_id, document_row=row_index, errors=errors))
             # maybe do it later, after all values are good
-    # print([entry.values for entry in id_entry_map.values()])
     # todo bring this back
     display_errors(all_errors)
     if post_creation_script:
-        post_creation_script(id_entry_map)
-    return list(id_entry_map.values())
+        post_creation_script(
+            {row_id: entries[row_id] for row_id in created_ids} if dense_ids else entries)
+    if dense_ids:
+        return [entries[row_id] for row_id in created_ids]
+    return list(entries.values())
 
 
-def display_errors(row_errors: List[RowError]):
-    item_errors: List[ItemError] = []
-    for error in row_errors:
-        item_errors.extend(error.errors)
+def parse_row_ids(rows: List[List[str]], id_index: int) -> List[Optional[int]]:
+    """
+    the integer ids of the rows, None for rows which id is not an integer
+    """
+    row_ids: List[Optional[int]] = []
+    for row in rows:
+        id_ = row[id_index]
+        # plain digits are the common case, int() also takes signs and whitespace
+        if id_.isdecimal():
+            row_ids.append(int(id_))
+        else:
+            try:
+                row_ids.append(int(id_))
+            except ValueError:
+                row_ids.append(None)
+    return row_ids
 
-    aspect_errors_map: dict[MappingAspectOutput, Set[ItemError]] = {}
-    for error in item_errors:
-        aspect_errors_map.setdefault(error.output_aspect, set()).add(error)
 
-    for aspect_out, item_errors in aspect_errors_map.items():
+def display_errors(row_errors: List[RowError]):
+    # aspect -> value -> row_ids. row_ids are dict keys, so the same error in one row is only counted once
+    grouped_errors: Dict[MappingAspectOutput, Dict[str, Dict[int, None]]] = defaultdict(lambda: defaultdict(dict))
+    total_errors = 0
+    for row_error in row_errors:
+        for item_error in row_error.errors:
+            value_row_ids = grouped_errors[item_error.output_aspect][item_error.value]
+            if item_error.row_id not in value_row_ids:
+                value_row_ids[item_error.row_id] = None
+                total_errors += 1
+
+    for aspect_out, value_errors in grouped_errors.items():
         # column_aspect_def = next(filter(lambda col__aspect_pos: col__aspect_pos[1].aspect_pos == aspect_pos,
         #                                 column_aspect_pos_mapping.items()))
         input_field = aspect_out.assigned_input.field
         print(Fore.GREEN + f"{aspect_out.aspect_pos} / input_field: {input_field}")
-        grouped_item_errors = {}
-        for item_error in item_errors:
-            grouped_item_errors.setdefault(item_error.value, []).append(item_error.row_id)
-        print(Fore.RED + f"Found: {list(grouped_item_errors.items())}")
+        print(Fore.RED + f"Found: {[(value, list(row_ids)) for value, row_ids in value_errors.items()]}")
         # aspect_pos: MappingAspectOutput = column_aspect_def[1]
         if not isinstance(aspect_out.aspect.items, str):
-            items = aspect_out.aspect.dict(exclude_none=True)['items']
-            for item in items:
-                print(Fore.YELLOW + f"{item['text']} | {item['value']}")
+            for item in aspect_out.aspect.items:
+                print(Fore.YELLOW + f"{item.text} | {item.value}")
 
-    total_errors = 0
-    for error_aspect in aspect_errors_map.values():
-        total_errors += len(error_aspect)
-    print(Fore.GREEN + f'{len(list(aspect_errors_map.keys()))} aspects with errors found')
+    print(Fore.GREEN + f'{len(grouped_errors)} aspects with errors found')
     print(Fore.GREEN + f'{total_errors} errors in total found')
     print(Fore.BLACK)
 
 
-def load_and_assign_code_entries(template_model: TemplateMerge, aspects: List[MappingAspectOutput],
+def load_and_assign_code_entries(template_model: TemplateMerge, aspects: Iterable[MappingAspectOutput],
                                  ref_entries_map: dict[str, TemplateMerge]):
     """
     loads, verifies (checks all aspects vs  slug) and assigns them to the AspectPosDefinition code_entry
+    aspects with a list of items get their items_index instead
     """
     references: List[EntryEntryRef] = template_model.entry_refs
     # [1:] because the first character is a dot.
@@ -165,7 +216,7 @@ def load_and_assign_code_entries(template_model: TemplateMerge, aspects: List[Ma
     # ref_entries_map = {ref.destination_id: TemplateMerge.from_orm(ref.destination) for ref in references if
     #                    ref.destination_id not in ref_entries_map}
     for aspect_def in aspects:
-        if aspect_def.aspect.type in [SELECT, MULTISELECT, TREE, TREEMULTISELECT]:
+        if aspect_def.aspect.type in SELECT_TYPES:
             if isinstance(aspect_def.aspect.items, str):
                 code_slug = aspect_def.aspect.items
                 if aspect_def.aspect_pos not in reference_aspect_path_entry_map:
@@ -177,90 +228,81 @@ def load_and_assign_code_entries(template_model: TemplateMerge, aspects: List[Ma
                                      f"slug in aspect: '{code_slug}', in reference: "
                                      f"'{reference.dest_slug}'")
                 aspect_def.code_entry = ref_entries_map[code_slug]
+                if aspect_def.code_entry.rules.code_schema == VALUE_TREE:
+                    aspect_def.tree_root = aspect_def.code_entry.values.root.dict(exclude_none=True)
+                    aspect_def.tree_find_index = build_find_index(aspect_def.tree_root)
                 # print(f"assigned code entry {aspect_def.code_entry} to aspect {aspect_def.aspect_pos}")
+            else:
+                # first item wins, value or text, just like a scan over the items
+                for item in aspect_def.aspect.items:
+                    aspect_def.items_index.setdefault(item.value, (item.value, item.text))
+                    aspect_def.items_index.setdefault(item.text, (item.value, item.text))
 
 
-def read_row(row: dict, entry: EntryRegular, mapping: Dict[MappingValueInput, MappingAspectOutput]) -> List[ItemError]:
-    errors = []
-    for key, value in row.items():
-        clean_key = key.strip()
-        if value:
-            if clean_key in mapping:
-                output_aspect: MappingAspectOutput = mapping[clean_key]
-                errors.extend(set_value(entry, output_aspect, value.strip()))
+def read_row(row: List[str], entry: EntryRegular, mapped_columns: List[Tuple[int, MappingAspectOutput]]) -> \
+        Optional[List[ItemError]]:
+    """
+    set the values of the mapped columns of a row
+    @param mapped_columns: pairs of the column index and the aspect output it is mapped to
+    @return: the errors or None, if there are none
+    """
+    errors = None
+    for index, output_aspect in mapped_columns:
+        if value := row[index]:
+            # most cells are clean, only strip when needed
+            if value[0].isspace() or value[-1].isspace():
+                value = value.strip()
+            if item_errors := set_value(entry, output_aspect, value):
+                if errors is None:
+                    errors = item_errors
+                else:
+                    errors.extend(item_errors)
     return errors
 
 
 def set_value(entry: EntryRegular, output_aspect: MappingAspectOutput, value: str, list_indices: List[int] = [],
               use_exceptional_aspect_pos: bool = False) -> \
         List[ItemError]:
-    def split_path(path_: str) -> List[str]:
-        return path_.split(".")
-
     try:
         if use_exceptional_aspect_pos:
             output_aspect: AspectMappingDefinitionExceptionalValue = output_aspect
             path = output_aspect.exceptional_aspect_pos
         else:
             path = output_aspect.aspect_pos
-        path_parts = split_path(path)
-        current_val = entry.values
-        in_list = False
-        current_aspect_type = None
-        current_list_index = -1  # this is not the index in the list, but which list... (tho usually just 1)
+        # both precomputed during validation
+        terminal_kind = output_aspect.terminal_kind
         errors: List[ItemError] = []
-        for index, part in enumerate(path_parts):
-            try:
-                current_aspect_type = output_aspect.types[index]
-                if not in_list:
-                    if index > 0:  # composite
-                        current_val = current_val[VALUE]
-                    # top level aspect or component
-                    current_val = current_val.setdefault(part, current_aspect_type)
-                else:
-                    if index == len(path_parts) - 1:
-                        break
-                    else:
-                        current_val = current_val[list_indices[current_list_index]]
-                if current_aspect_type == LIST:
-                    in_list = True
-                    current_list_index += 1
-            except Exception as err:
-                print(f"crash on value: {value}. {index}, {part}")
-                print(err)
+        current_val = output_aspect.walker(entry.values, list_indices)
         # set value
-        if in_list:
-            list_values = [v.strip() for v in value.split(",")]
-            if current_aspect_type in SELECT_TYPES:
-                if current_aspect_type == MULTISELECT:
-                    raise ValueError(f"MULTISELECT in list is not supported: {path}")
-                result, exceptional_values, sel_errors = get_select_values(value, output_aspect, path, False)
-                if result:
-                    result = [pack_raw_value(item) for item in result]
-                # TODO exceptional value handling
-                errors.extend(sel_errors)
-            else:
-                result = [{VALUE: value} for value in list_values]
+        if terminal_kind == TERMINAL_SCALAR:
+            # values come stripped from read_row and get_select_values
+            current_val[VALUE] = value
+        elif terminal_kind == TERMINAL_SELECT:
+            select_value, exceptional_value, item_error = get_select_value(value, output_aspect, path,
+                                                                           False)
+            if select_value:
+                current_val[VALUE] = select_value[VALUE]
+                current_val[TEXT] = select_value[TEXT]
+            if item_error:
+                errors.append(item_error)
+        elif terminal_kind == TERMINAL_MULTISELECT:
+            select_values, exceptional_values, sel_errors = get_select_values(value, output_aspect, path)
+            errors.extend(sel_errors)
+            current_val[VALUE] = select_values
+            if exceptional_values:
+                for (aspect_pos_def, value) in exceptional_values:
+                    set_value(entry, aspect_pos_def, value, use_exceptional_aspect_pos=True)
+        elif terminal_kind == TERMINAL_LIST_SELECT:
+            if output_aspect.types[-1] == MULTISELECT:
+                raise ValueError(f"MULTISELECT in list is not supported: {path}")
+            result, exceptional_values, sel_errors = get_select_values(value, output_aspect, path, False)
+            if result:
+                result = [pack_raw_value(item) for item in result]
+            # TODO exceptional value handling
+            errors.extend(sel_errors)
             current_val[VALUE] = result
-        else:
-            if current_aspect_type == MULTISELECT:
-                select_values, exceptional_values, sel_errors = get_select_values(value, output_aspect, path)
-                errors.extend(sel_errors)
-                current_val[VALUE] = select_values
-                if exceptional_values:
-                    for (aspect_pos_def, value) in exceptional_values:
-                        set_value(entry, aspect_pos_def, value, use_exceptional_aspect_pos=True)
-
-            elif current_aspect_type in SELECT_TYPES:  # still includes MULTISELECT, but is catched before
-                select_value, exceptional_value, item_error = get_select_value(value, output_aspect, path,
-                                                                               False)
-                if select_value:
-                    current_val[VALUE] = select_value[VALUE]
-                    current_val[TEXT] = select_value[TEXT]
-                if item_error:
-                    errors.append(item_error)
-            else:
-                current_val[VALUE] = value.strip()
+        else:  # TERMINAL_LIST
+            current_val[VALUE] = [{VALUE: v.strip()} for v in value.split(",")]
         return errors
     except Exception as e:
         print(f"crash on {path} with {value}")
@@ -299,9 +341,12 @@ def get_select_value(value: Any, output_aspect: MappingAspectOutput, path: str,
     aspect = output_aspect.aspect
     if isinstance(aspect.items, str):
         if output_aspect.code_entry.rules.code_schema == VALUE_TREE:
-            entry = output_aspect.code_entry
-            tree_root = entry.values.root.dict(exclude_none=True)
-            tree_values, last_node_has_children = find_by(tree_root, value)
+            if (tree_values := output_aspect.tree_values_cache.get(value)) is None:
+                tree_values, last_node_has_children = find_by(
+                    output_aspect.tree_root, value, index=output_aspect.tree_find_index)
+                output_aspect.tree_values_cache[value] = tree_values
+            # the values end up in the entries, which must not share them
+            tree_values = [dict(tree_value) for tree_value in tree_values]
             # validation = validate_value(entry.values.dict(exclude_none=True), tree_values, aspect)
             if tree_values:
                 return tree_values, None, None
@@ -310,9 +355,8 @@ def get_select_value(value: Any, output_aspect: MappingAspectOutput, path: str,
                         None,  # todo exceptional value?
                         ItemError(output_aspect=output_aspect, value=str(value)))
     else:
-        for item in aspect.items:
-            if item.value == value or item.text == value:
-                return {VALUE: item.value, TEXT: item.text}, None, None  # todo exceptional value?
+        if item := output_aspect.items_index.get(value):
+            return {VALUE: item[0], TEXT: item[1]}, None, None  # todo exceptional value?
         #  logger.debug(f"could not find value: {value} in items: {[item.dict(exclude_none=True)
         #  for item in aspect.items]}")
         if isinstance(output_aspect.mapping_definition, AspectMappingDefinitionExceptionalValue):
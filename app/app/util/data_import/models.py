@@ -1,10 +1,36 @@
-from dataclasses import dataclass
-from typing import List, Optional, Union, Dict, Tuple, Literal, get_args, Any
+import sys
+from dataclasses import dataclass, field
+from logging import getLogger
+from typing import List, Optional, Union, Dict, Tuple, Literal, get_args, Any, KeysView, ValuesView, ItemsView, \
+    Iterator, Callable, Sequence
 
 from pydantic import BaseModel, root_validator, ValidationError
 
 from app.models.schema import TemplateMerge
 from app.models.schema.aspect_models import AspectMerge
+from app.util.common import DATACLASS_SLOTS
+from app.util.consts import LIST, MULTISELECT, SELECT_TYPES, VALUE
+from app.util.tree_funcs import FindIndex
+
+logger = getLogger(__name__)
+
+# how the value of a terminal aspect is written, determined once from the types of the path
+TERMINAL_SCALAR = "scalar"
+TERMINAL_LIST = "list"
+TERMINAL_LIST_SELECT = "list_select"
+TERMINAL_MULTISELECT = "multiselect"
+TERMINAL_SELECT = "select"
+
+
+def get_terminal_kind(types: List[str]) -> str:
+    terminal_type = types[-1]
+    if LIST in types:
+        return TERMINAL_LIST_SELECT if terminal_type in SELECT_TYPES else TERMINAL_LIST
+    if terminal_type == MULTISELECT:
+        return TERMINAL_MULTISELECT
+    if terminal_type in SELECT_TYPES:
+        return TERMINAL_SELECT
+    return TERMINAL_SCALAR
 
 
 class MappingValueInput(BaseModel):
@@ -14,6 +40,10 @@ class MappingValueInput(BaseModel):
     field: str
     source: str
 
+    class Config:
+        # hashed by field
+        allow_mutation = False
+
     def __eq__(self, other: Union[str, "MappingValueInput"]) -> bool:
         if isinstance(other, str):
             return self.field == other
@@ -26,6 +56,54 @@ class MappingValueInput(BaseModel):
         return hash(self.field)
 
 
+# takes the entry values and the list indices and returns the value of the terminal aspect
+Walker = Callable[[dict, Sequence[int]], dict]
+
+
+def make_walker(walk_steps: Tuple[Tuple[str, str], ...]) -> Walker:
+    """
+    build a function, that walks down the entry values along the steps of one path, so the
+    steps do not need to be checked for their type and position for every value.
+    Until (including) the first list, aspects/components are entered by name, after that the list items
+    are selected by the list indices. The terminal step within a list is not entered.
+    """
+    list_pos = next((index for index, (_, type_) in enumerate(walk_steps) if type_ == LIST), None)
+    enter_steps = walk_steps if list_pos is None else walk_steps[:list_pos + 1]
+    first_part, first_type = enter_steps[0]
+    component_steps = enter_steps[1:]
+
+    if list_pos is None:
+        def walk(values: dict, list_indices: Sequence[int] = ()) -> dict:
+            current_val = values.setdefault(first_part, first_type)
+            for part, type_ in component_steps:
+                current_val = current_val[VALUE].setdefault(part, type_)
+            return current_val
+
+        return walk
+
+    # which of the list indices each step within the list uses
+    list_index_positions = []
+    current_list_index = 0
+    for part, type_ in walk_steps[list_pos + 1:-1]:
+        list_index_positions.append((part, current_list_index))
+        if type_ == LIST:
+            current_list_index += 1
+
+    def walk_into_list(values: dict, list_indices: Sequence[int] = ()) -> dict:
+        current_val = values.setdefault(first_part, first_type)
+        for part, type_ in component_steps:
+            current_val = current_val[VALUE].setdefault(part, type_)
+        for part, list_index_pos in list_index_positions:
+            try:
+                current_val = current_val[list_indices[list_index_pos]]
+            except Exception as err:
+                # the value is set on the current level
+                logger.warning(f"could not step into the list at: {part}: {err}")
+        return current_val
+
+    return walk_into_list
+
+
 class AspectMappingDefinitionBase(BaseModel):
     """
     base class for a destination in the  mapping definition (what a field maps to)
@@ -46,6 +124,8 @@ class AspectMappingDefinitionExceptionalValue(AspectMappingDefinitionBase):
     activator_value: str  # value that should be assigned on the original aspect_pos
     #
     types: Optional[List[str]] # set later in validation
+    walker: Optional[Callable]  # set later in validation
+    terminal_kind: Optional[str]  # set later in validation
 
 
 class AspectMappingDefinitionJSON(AspectMappingDefinitionBase):
@@ -57,7 +137,7 @@ AspectMappingDefinition = Union[
 
 # AlternativeMappingDefinitions =[AspectMappingDefinitionExceptionalValue,AspectMappingDefinitionJSON]
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class MappingAspectOutput:
     """
     model for description of a aspect in a template. mapping_definition is added during validation
@@ -70,6 +150,27 @@ class MappingAspectOutput:
     # added during validation
     assigned_input: Optional[MappingValueInput] = None
     mapping_definition: Optional[AspectMappingDefinition] = None
+    # derived from aspect_pos and types, so set_value does not need to split and index per row
+    path_parts: Tuple[str, ...] = field(init=False, repr=False)
+    walk_steps: Tuple[Tuple[str, str], ...] = field(init=False, repr=False)
+    terminal_kind: str = field(init=False, repr=False)
+    walker: Walker = field(init=False, repr=False)
+    # value and text of the items (for list items), mapped to (value, text). set in load_and_assign_code_entries
+    items_index: Dict[str, Tuple[str, str]] = field(default_factory=dict, repr=False)
+    # root of the code entry tree as dict (VALUE_TREE). set in load_and_assign_code_entries
+    tree_root: Optional[dict] = field(default=None, repr=False)
+    # index of tree_root for find_by. set with tree_root
+    tree_find_index: Optional[FindIndex] = field(default=None, repr=False)
+    # results of find_by in the code entry tree (VALUE_TREE), by value
+    tree_values_cache: Dict[str, List[Dict[str, str]]] = field(default_factory=dict, repr=False)
+
+    def __post_init__(self):
+        # interned, since it is used for hashing and comparing
+        self.aspect_pos = sys.intern(self.aspect_pos)
+        self.path_parts = tuple(self.aspect_pos.split("."))
+        self.walk_steps = tuple(zip(self.path_parts, self.types))
+        self.terminal_kind = get_terminal_kind(self.types)
+        self.walker = make_walker(self.walk_steps)
 
     def __hash__(self):
         return hash(self.aspect_pos)
@@ -101,23 +202,26 @@ class Mapping(BaseModel):
                 #     pass
         return values
 
-    def keys(self) -> List[str]:
-        for key in self.__root__.keys():
-            yield key
+    def keys(self) -> KeysView[str]:
+        return self.__root__.keys()
 
-    def values(self) -> List[AspectMappingDefinition]:
-        for value in self.__root__.values():
-            yield value
+    def values(self) -> ValuesView[AspectMappingDefinition]:
+        return self.__root__.values()
 
-    def items(self) -> List[Tuple[str, AspectMappingDefinition]]:
-        for key, value in self.__root__.items():
-            yield key, value
+    def items(self) -> ItemsView[str, AspectMappingDefinition]:
+        return self.__root__.items()
 
     def __getitem__(self, key) -> AspectMappingDefinition:
         return self.__root__[key]
 
+    def __contains__(self, key) -> bool:
+        return key in self.__root__
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__root__)
+
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class ItemError:
     output_aspect: MappingAspectOutput
     value: str
@@ -1,5 +1,5 @@
 from collections import Counter
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Set
 
 from app.util.files import CSVPath
 
@@ -53,25 +53,43 @@ def value_fixer(input_file: CSVPath, fixer_config: dict, output_path: CSVPath, r
             for column_name in column_names:
                 fixes.update(fixer_config.get(column_name, {}))
                 fixer_config[column_name] = fixes
+    # resolve the fixes of each column once, instead of per cell
+    column_fixes = []
+    for field_name in fieldnames:
+        if (fixes := fixer_config.get(field_name)) is not None:
+            missing = missing_values.setdefault(field_name, set()) if report_unfixed_values else None
+            column_fixes.append((field_name, fixes, set(fixes.values()), missing))
+        else:
+            column_fixes.append((field_name, None, None, None))
     for row in reader:
         result_row = {}
-        for key, value in row.items():
-            field_name = key.strip()
-            if field_name in fixer_config:
-                values = value.split(",")
-                result_values = []
-                for ind_value in values:
-                    clean_value = ind_value.strip()
-                    if clean_value in fixer_config[field_name]:
-                        result_values.append(fixer_config[field_name][clean_value])
-                    else:
-                        result_values.append(clean_value)
-                        if report_unfixed_values and clean_value not in fixer_config[field_name].values():
-                            missing_values.setdefault(field_name, set()).add(clean_value)
-                result_row[field_name] = ",".join(result_values)
+        for (field_name, fixes, fix_results, missing), value in zip(column_fixes, row.values()):
+            if fixes is not None:
+                result_row[field_name] = _apply_fixes(value, fixes, fix_results, missing)
             else:
                 result_row[field_name] = value.strip()
         result_rows.append(result_row)
+    # only keep the columns that actually have unfixed values
+    missing_values = {field_name: values for field_name, values in missing_values.items() if values}
     output_path.write(result_rows, fieldnames)
     if report_unfixed_values:
         return missing_values
+
+
+def _apply_fixes(value: str, fixes: Dict[str, str], fix_results: Set[str], missing: Optional[Set[str]]) -> str:
+    """
+    fix the comma separated values of a cell
+    @param fixes: value -> fixed value
+    @param fix_results: the values of fixes, (values that are already fixed)
+    @param missing: collects values without a fix, if given
+    """
+    result_values = []
+    for ind_value in value.split(","):
+        clean_value = ind_value.strip()
+        if clean_value in fixes:
+            result_values.append(fixes[clean_value])
+        else:
+            result_values.append(clean_value)
+            if missing is not None and clean_value not in fix_results:
+                missing.add(clean_value)
+    return ",".join(result_values)
@@ -1,17 +1,21 @@
+import hashlib
 import itertools
 from logging import getLogger
 from typing import Any, Dict, Union, List, Tuple, Sequence, Callable, Set, Iterator
 
-from deepdiff import deephash, DeepDiff
+from deepdiff import deephash
 from deepmerge import Merger, STRATEGY_END
 from deepmerge.exception import InvalidMerge
 from pydantic import BaseModel
-from pymemcache.client.murmur3 import murmur3_32
 
 from app.util.consts import TEXT, MESSAGE_TABLE_INDEX_COLUMN, NAME
 
 logger = getLogger(__name__)
 
+# types that are walked into (dict, list) or flattened (set, list)
+_CONTAINER_TYPES = (dict, list)
+_FLATTEN_TYPES = (set, list)
+
 
 def pull_dict_up(data: Dict, key_to_pull: str) -> Dict:
     """
@@ -40,18 +44,20 @@ def pull_up(
 
 
 def delete_none(data: Dict) -> Dict:
-    to_del = []
-    for (k, v) in data.items():
-        if v is None:
-            to_del.append(k)
-        if type(v) == dict:
-            delete_none(v)
-        elif type(v) == list:
-            for i in v:
-                if type(i) == dict:
-                    delete_none(i)
-    for k in to_del:
-        del data[k]
+    """
+    removes all keys with None values from data and the dicts nested in it (also in lists).
+    destructive
+    """
+    stack = [data]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, dict):
+            for k in [k for (k, v) in current.items() if v is None]:
+                del current[k]
+            values = current.values()
+        else:
+            values = current
+        stack.extend(v for v in values if isinstance(v, _CONTAINER_TYPES))
     return data
 
 
@@ -108,11 +114,19 @@ def update_strict(origin: dict, d2: dict):
     origin.update(**{k: d2[k] for k in d2 if k in origin})
 
 
+def _blake2b_64(obj: Union[str, bytes]) -> int:
+    """
+    64 bit hash for DeepHash. hashlib runs in C, unlike the pure python murmur3 of pymemcache
+    """
+    if isinstance(obj, str):
+        obj = obj.encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(obj, digest_size=8).digest(), "little")
+
+
 def obj_hash(data: Union[Dict, List, Tuple]) -> bytes:
     # todo could maybe also be *args
-    # print(bytes(deephash.DeepHash(data, hasher=murmur3_32)[data]))
-    # print(str(deephash.DeepHash(data, hasher=murmur3_32)[data]).encode("utf-8"))
-    return str(deephash.DeepHash(data, hasher=murmur3_32)[data]).encode("utf-8")
+    # not memoized: the data is usually mutable, so neither the object nor its id are a safe key
+    return str(deephash.DeepHash(data, hasher=_blake2b_64)[data]).encode("utf-8")
 
 
 def _list_item_merge_strategy(config: Merger, path, base: list, nxt: list):
@@ -146,6 +160,19 @@ def fallback(config: Merger, path, base, nxt):
     return STRATEGY_END
 
 
+def _create_merger(list_strategy: Callable) -> Merger:
+    return Merger([(list, list_strategy), (dict, "merge")], ["override"], [fallback])
+
+
+# mergers hold no state between merges, so they are built once
+_MERGER_STRICT = _create_merger(_strict_list_item_merge_strategy)
+_MERGER_LAX = _create_merger(_list_item_merge_strategy)
+
+
+def _get_merger(strict: bool) -> Merger:
+    return _MERGER_STRICT if strict else _MERGER_LAX
+
+
 def deep_merge(base: Dict, update: Dict, strict: bool = False):
     """
     makes a deepmerge through dict, list.
@@ -157,38 +184,13 @@ def deep_merge(base: Dict, update: Dict, strict: bool = False):
     @param strict: list must have same length
     @return:
     """
-    base_merger = Merger(
-        [
-            (
-                list,
-                _strict_list_item_merge_strategy
-                if strict
-                else _list_item_merge_strategy,
-            ),
-            (dict, "merge"),
-        ],
-        ["override"],
-        [fallback],
-    )
-    return base_merger.merge(base, update)
+    return _get_merger(strict).merge(base, update)
 
 
 def merge_aspects_one_by_one(base: Dict, update: Dict, strict: bool = False):
     base_aspects = base.get("aspects", [])
     update_aspects = update.get("aspects", [])
-    base_merger = Merger(
-        [
-            (
-                list,
-                _strict_list_item_merge_strategy
-                if strict
-                else _list_item_merge_strategy,
-            ),
-            (dict, "merge"),
-        ],
-        ["override"],
-        [fallback],
-    )
+    base_merger = _get_merger(strict)
     result = []
     for index,base_aspect in enumerate(base_aspects):
         try:
@@ -199,13 +201,22 @@ def merge_aspects_one_by_one(base: Dict, update: Dict, strict: bool = False):
     return result
 
 def flatten_sequence(seq: Sequence) -> List:
-    if type(seq) in {set}:
-        seq = list(seq)
-    if len(seq) == 0:
-        return seq
-    if type(seq[0]) in {set, list}:
-        return flatten_sequence(seq[0]) + flatten_sequence(seq[1:])
-    return seq[:1] + flatten_sequence(seq[1:])
+    """
+    flattens nested lists and sets (depth first, in order) into one list
+    """
+    result = []
+    stack = [iter(seq)]
+    while stack:
+        try:
+            item = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        if isinstance(item, _FLATTEN_TYPES):
+            stack.append(iter(item))
+        else:
+            result.append(item)
+    return result
 
 
 def extract_diff(a, b):
@@ -220,93 +231,62 @@ def extract_diff(a, b):
     @param b:
     @return:
     """
-    res = {}
-    if type(a) == type(b) and type(a) not in [list, dict]:
+    if type(a) is type(b) and not isinstance(a, _CONTAINER_TYPES):
         return None
     if isinstance(a, list):
         assert len(a) == len(b)
-        res = []
-        for index, _ in enumerate(a):
-            t = extract_diff(a[index], b[index])
-            if t:
-                res.append(t)
-        return res
+        return [t for t in map(extract_diff, a, b) if t]
 
+    res = {}
     for k, av in a.items():
-        if b == None or k not in b:
+        if b is None or k not in b:
             res[k] = av
-            continue
-        bv = b.get(k)
-        if isinstance(av, dict):
-            t = extract_diff(av, bv)
-            if t:
+        elif isinstance(av, dict):
+            if t := extract_diff(av, b[k]):
                 res[k] = t
         elif isinstance(av, list):
+            bv = b[k]
             assert len(av) == len(bv)
-            res[k] = []
-            for index, _ in enumerate(av):
-                t = extract_diff(av[index], bv[index])
-                if t:
-                    res[k].append(t)
+            res[k] = [t for t in map(extract_diff, av, bv) if t]
     return res
 
 
-def dict2row_iter(lang_data):
-    def rec_key(data, parent: str = ""):
-        if type(data) == dict:
-            go_into = {}
-            for k, v in data.items():
-                if type(v) not in [dict, list]:
-                    yield parent + k, v
+def _iter_flat_items(data: Union[Dict, List]) -> Iterator[Tuple[str, Any]]:
+    """
+    depth first walk through dicts and lists, that yields the (index-path, value) of all other values.
+    within a dict its plain values come before the nested ones, list items stay in order
+    """
+    # (is_leaf, index-path or prefix, value)
+    stack: List[Tuple[bool, str, Any]] = [(False, "", data)]
+    while stack:
+        is_leaf, path, value = stack.pop()
+        if is_leaf:
+            yield path, value
+        elif isinstance(value, dict):
+            nested = []
+            for k, v in value.items():
+                if isinstance(v, _CONTAINER_TYPES):
+                    nested.append((False, f"{path}{k}.", v))
                 else:
-                    go_into[k] = v
-            for k, v in go_into.items():
-                for res in rec_key(v, parent + k + "."):
-                    yield res
+                    yield f"{path}{k}", v
+            stack.extend(reversed(nested))
         else:
-            for k, v in enumerate(data):
-                if type(v) not in [dict, list]:
-                    yield parent + str(k), v
-                else:
-                    for res in rec_key(v, parent + str(k) + "."):
-                        yield res
+            stack.extend(reversed([
+                (True, f"{path}{index}", v) if not isinstance(v, _CONTAINER_TYPES) else (False, f"{path}{index}.", v)
+                for index, v in enumerate(value)]))
 
-    return rec_key(lang_data)
+
+def dict2row_iter(lang_data):
+    return _iter_flat_items(lang_data)
 
 
 def dict2index_dict(dict_data: dict):
     """
-    recursively runs through a dict and turn it into a flat dict,
+    runs through a dict and turn it into a flat dict,
     where they keys are the indices and values are ... the values under the given index-path
     @return:
     """
-    result = {}
-
-    def a_rec_key(data, parent: str = ""):
-        if type(data) == dict:
-            go_into = {}
-            for k, v in data.items():
-                if type(v) not in [dict, list]:
-                    result[parent + k] = v
-                else:
-                    go_into[k] = v
-            for k, v in go_into.items():
-                a_rec_key(v, parent + k + ".")
-                # for res in :
-                #     result[res[0]] = res[1]
-        else:
-            for k, v in enumerate(data):
-                if type(v) not in [dict, list]:
-                    result[parent + str(k)] = v
-                    # result[parent + str(k)] = v
-                else:
-                    a_rec_key(v, parent + str(k) + ".")
-                    # for res in :
-                    #     # yield res
-                    #     result[res[0]] = res[1]
-
-    a_rec_key(dict_data)
-    return result
+    return dict(_iter_flat_items(dict_data))
 
     # def validate_no_empty_text(data: dict) -> List[str]:
     #     def extend_path(parent: str, sub: str):
@@ -338,42 +318,50 @@ def dict_process_proc_results(data: dict, prc: Callable):
     """
 
     def rec_key(part, parent: str = ""):
-        if type(part) == dict:
-            go_into = {}
-            for k, v in part.items():
-                if type(v) not in [dict, list]:
-                    yield parent + k, prc(k, v)
-                else:
-                    go_into[k] = v
-            for k, v in go_into.items():
-                for res in rec_key(v, parent + k + "."):
-                    yield res
-        else:
-            for index, v in enumerate(part):
-                if type(v) not in [dict, list]:
-                    yield parent + str(index), prc(index, v)
-                else:
-                    for res in rec_key(v, parent + str(index) + "."):
-                        yield res
+        is_dict = isinstance(part, dict)
+        # dicts yield their own values before going into nested containers, lists keep their order
+        go_into = []
+        for k, v in (part.items() if is_dict else enumerate(part)):
+            path = f"{parent}{k}"
+            if not isinstance(v, _CONTAINER_TYPES):
+                yield path, prc(k, v)
+            elif is_dict:
+                go_into.append((v, path))
+            else:
+                yield from rec_key(v, path + ".")
+        for v, path in go_into:
+            yield from rec_key(v, path + ".")
 
     return rec_key(data)
 
 
 def validate_complete_texts(
         data: dict, text_keys: List[str] = (TEXT,)
-):  # could also include "label", "description"
-    def check_text(key, value):
-        if key in text_keys and value == "":
-            return "missing"
-        else:
-            return None
-
-    return [
-        k_v[0]
-        for k_v in filter(
-            lambda k_v: k_v[1], dict_process_proc_results(data, check_text)
-        )
-    ]
+) -> List[str]:  # could also include "label", "description"
+    """
+    index-paths of all empty texts (values of text_keys) in the data
+    """
+    text_keys = set(text_keys)
+    missing: List[str] = []
+    # (key, value, index-path or prefix), same order as dict_process_proc_results
+    stack: List[Tuple[Any, Any, str]] = [(None, data, "")]
+    while stack:
+        key, value, path = stack.pop()
+        if isinstance(value, dict):
+            nested = []
+            for k, v in value.items():
+                if isinstance(v, _CONTAINER_TYPES):
+                    nested.append((k, v, f"{path}{k}."))
+                elif k in text_keys and v == "":
+                    missing.append(f"{path}{k}")
+            stack.extend(reversed(nested))
+        elif isinstance(value, list):
+            stack.extend(reversed([
+                (index, v, f"{path}{index}." if isinstance(v, _CONTAINER_TYPES) else f"{path}{index}")
+                for index, v in enumerate(value)]))
+        elif key in text_keys and value == "":
+            missing.append(path)
+    return missing
 
 
 def check_model_active(
@@ -395,31 +383,31 @@ def check_model_active(
     """
     to_check_against = model_to_check_against.dict(include=keys, exclude_none=True)
     to_check = model_to_check.dict(include=keys, exclude_none=True)
-    diff = DeepDiff(to_check_against, to_check)
+    differences = _iter_text_differences(to_check_against, to_check)
 
-    if removed := diff.tree.get("dictionary_item_removed"):
-        if throw_warning:
+    if throw_warning:
+        # removed values make the model inactive, no matter what else changed
+        differences = list(differences)
+        if removed := [path for (kind, path, _) in differences if kind == _VALUE_REMOVED]:
             logger.warning(f"value missing in {identity}")
             logger.warning(f"{removed}")
             return False
 
     all_text_present = True
     missing: List[str] = []
-    if changes := diff.tree.get("values_changed"):
-        for change in changes.items:
-            if change.t1 != "" and change.t2 == "":
-                all_text_present = False
-                missing.append(change.t2)
-                change_repr = repr(change.up).replace("'", "")
-                change_repr = change_repr[5: (change_repr.index(" t1"))]
-                if throw_warning:
-                    logger.warning(
-                        f"missing text  at {change_repr} for {identity}. Original says: {change.t1}"
-                    )
-                else:
-                    logger.info(f"missing text  at {change_repr} for {identity}")
-                if not check_all:
-                    break
+    for (kind, path, original) in differences:
+        if kind != _TEXT_EMPTIED:
+            continue
+        all_text_present = False
+        missing.append(path)
+        if throw_warning:
+            logger.warning(
+                f"missing text  at {path} for {identity}. Original says: {original}"
+            )
+        else:
+            logger.info(f"missing text  at {path} for {identity}")
+        if not check_all:
+            break
 
     if not check_all:
         return all_text_present
@@ -427,41 +415,65 @@ def check_model_active(
         return missing
 
 
+_VALUE_REMOVED = "removed"
+_TEXT_EMPTIED = "emptied"
+
+
+def _iter_text_differences(original: Any, other: Any, path: str = "") -> Iterator[Tuple[str, str, Any]]:
+    """
+    walks both structures in lockstep and yields (kind, path, original value) for
+    dict keys that are missing in other (_VALUE_REMOVED) and
+    texts that are set in original but empty in other (_TEXT_EMPTIED).
+    lists are compared index by index, differing types are not followed.
+    @param original:
+    @param other:
+    @param path: path so far, e.g. [content][0]
+    """
+    if isinstance(original, dict):
+        if not isinstance(other, dict):
+            return
+        for (k, v) in original.items():
+            if k not in other:
+                yield _VALUE_REMOVED, f"{path}[{k}]", v
+            elif isinstance(v, _CONTAINER_TYPES):
+                yield from _iter_text_differences(v, other[k], f"{path}[{k}]")
+            elif isinstance(v, str) and v and other[k] == "":
+                yield _TEXT_EMPTIED, f"{path}[{k}]", v
+    elif isinstance(original, list):
+        if not isinstance(other, list):
+            return
+        for (index, (v, other_v)) in enumerate(zip(original, other)):
+            if isinstance(v, _CONTAINER_TYPES):
+                yield from _iter_text_differences(v, other_v, f"{path}[{index}]")
+            elif isinstance(v, str) and v and other_v == "":
+                yield _TEXT_EMPTIED, f"{path}[{index}]", v
+
+
 def merge_row_iters(languages: List[str], row_iters: Iterator[List]):
     rows = []
     done = False
-    last_language = languages[-1]
-    while True:
-        act_row = {}
+    language_iters = list(zip(languages, row_iters))
+    while not done:
+        language_values = {}
         act_index = None
-        for language, row_iter in zip(languages, row_iters):
+        for language, row_iter in language_iters:
             try:
                 current = next(row_iter)
-                # print(current)
-                if not act_index:
-                    act_index = current[0]
-                    act_row[act_index] = {}
-                    # print(act_index)
-                else:
-                    if current[0] != act_index:
-                        logger.warning(
-                            f"unequal index: {act_index} / {current[0]} for lang: {language}"
-                        )
-                        act_row[act_index][language] = None
-                        # print(f"{current[0]} / {act_index} ... next")
-                        continue
-                        # raise ValueError(f"unequal index: {act_index} / {current[0]}")
-                act_row[act_index][language] = current[1]
             except StopIteration:
-                # print("stopp")
-                # logger.warning("stopping")
                 done = True
                 break
-        if any((act_row[act_index][lang] for lang in languages)):
-            rows.append(act_row)
-        if done:
-            break
-    # print("done")
+            index = current[0]
+            if not act_index:
+                act_index = index
+            elif index != act_index:
+                logger.warning(
+                    f"unequal index: {act_index} / {index} for lang: {language}"
+                )
+                language_values[language] = None
+                continue
+            language_values[language] = current[1]
+        if any(language_values.values()):
+            rows.append({act_index: language_values})
     return rows
 
 
@@ -1,6 +1,8 @@
+import threading
 from email.message import EmailMessage
 from logging import getLogger
-from smtplib import SMTP_SSL, SMTPResponseException
+from smtplib import SMTP_SSL, SMTPResponseException, SMTPException
+from typing import Set
 from urllib.parse import urljoin
 
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
@@ -10,6 +12,70 @@ from app.util.exceptions import ApplicationException
 
 logger = getLogger(__name__)
 
+# one logged-in connection per thread, reused across mails
+_smtp_local = threading.local()
+_smtp_connections: Set[SMTP_SSL] = set()
+_smtp_connections_lock = threading.Lock()
+
+
+def _login_smtp(env) -> SMTP_SSL:
+    smtp = SMTP_SSL(env.EMAIL_SSL_SERVER)
+    try:
+        smtp.login(env.EMAIL_ACCOUNT, env.EMAIL_PWD.get_secret_value())
+    except SMTPException:
+        _quit_smtp(smtp)
+        raise
+    _smtp_local.smtp = smtp
+    with _smtp_connections_lock:
+        _smtp_connections.add(smtp)
+    return smtp
+
+
+def _quit_smtp(smtp: SMTP_SSL):
+    try:
+        smtp.quit()
+    except (SMTPException, OSError):
+        smtp.close()
+
+
+def _drop_smtp():
+    """
+    closes the connection of the current thread
+    """
+    smtp = getattr(_smtp_local, "smtp", None)
+    if smtp is None:
+        return
+    _smtp_local.smtp = None
+    with _smtp_connections_lock:
+        _smtp_connections.discard(smtp)
+    _quit_smtp(smtp)
+
+
+def _get_smtp(env) -> SMTP_SSL:
+    """
+    returns the connection of the current thread, if the server still answers, otherwise logs in again
+    """
+    smtp = getattr(_smtp_local, "smtp", None)
+    if smtp is not None:
+        try:
+            if smtp.noop()[0] == 250:
+                return smtp
+        except (SMTPException, OSError):
+            pass
+        _drop_smtp()
+    return _login_smtp(env)
+
+
+def close_smtp():
+    """
+    closes all open smtp connections. called on shutdown
+    """
+    with _smtp_connections_lock:
+        connections = list(_smtp_connections)
+        _smtp_connections.clear()
+    for smtp in connections:
+        _quit_smtp(smtp)
+
 
 def send_mail(receiver: str, subject: str, content: str):
     msg = EmailMessage()
@@ -20,10 +86,9 @@ def send_mail(receiver: str, subject: str, content: str):
     msg.set_content(content)
 
     try:
-        with SMTP_SSL(env.EMAIL_SSL_SERVER) as smtp:
-            smtp.login(env.EMAIL_ACCOUNT, env.EMAIL_PWD.get_secret_value())
-            smtp.send_message(msg)
+        _get_smtp(env).send_message(msg)
     except SMTPResponseException as exc:
+        _drop_smtp()
         logger.exception(exc)
         logger.critical(f"For email username: {env.EMAIL_ACCOUNT}")
         raise ApplicationException(
@@ -10,6 +10,9 @@ from app.models.orm import Entry
 
 logger = getLogger(__name__)
 
+# exception data of these exact types is already json-serializable
+_PLAIN_DATA_TYPES = frozenset({type(None), str, int, float, bool})
+
 
 class ApplicationException(Exception):
     def __init__(
@@ -25,12 +28,15 @@ class ApplicationException(Exception):
 
 
 async def application_exception_handler(request: Request, exc: ApplicationException):
+    data = exc.data
+    if type(data) not in _PLAIN_DATA_TYPES:
+        data = jsonable_encoder(data)
     return JSONResponse(
         status_code=exc.status_code,
         content={
             "code": exc.status_code,
             "msg": exc.msg,
-            "data": jsonable_encoder(exc.data),
+            "data": data,
             "error": {"msg": exc.msg},
         },
     )
@@ -1,25 +1,27 @@
 import _csv
+import asyncio
 import csv
-import json
+import io
+import mmap
 import os
 import pathlib
 import re
 import shutil
+import threading
 import zipfile
 from csv import DictReader
 from datetime import datetime
+from functools import lru_cache
 from glob import glob
 from logging import getLogger
 from os import makedirs, path
 from os.path import basename, isabs, isdir, isfile, join, splitext
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-from typing import Dict, List, Type, Union, IO, Sequence, Tuple
+from tempfile import NamedTemporaryFile, mkstemp
+from typing import Dict, List, Type, Union, IO, Sequence, Tuple, Optional
+from unicodedata import normalize
 
-import aiofiles
-from aiofiles.os import remove as async_remove
-
-import chardet
+from chardet.universaldetector import UniversalDetector
 import orjson
 from deepdiff import DeepDiff
 from deprecated.classic import deprecated
@@ -32,10 +34,29 @@ from app.util.common import iso_date_str
 
 logger = getLogger()
 
+# orjson serializes non-str keys and numpy values itself, instead of failing or calling default
+ORJSON_DUMP_OPTION = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+ORJSON_DUMP_OPTION_INDENT = ORJSON_DUMP_OPTION | orjson.OPT_INDENT_2
+
+# smaller files are read directly, since setting up the mapping costs more than it saves
+MMAP_READ_MIN_SIZE = mmap.PAGESIZE
+# allow long texts in csv cells (default is 128 KiB)
+CSV_FIELD_SIZE_LIMIT = 16 * 1024 * 1024
+
+csv.field_size_limit(CSV_FIELD_SIZE_LIMIT)
+
+# fast compression for the exports, the output is only slightly bigger than with the default (6)
+ZIP_COMPRESS_LEVEL = 1
+# files that are stored into zip files without compression
+COMPRESSED_SUFFIXES = frozenset({".zip", ".gz", ".png", ".jpg", ".jpeg", ".webp", ".pdf"})
+
+# chunk size for copying uploaded files
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
 
 def orjson_dumps(v, *, default):
-    # orjson.dumps returns bytes, to match standard json.dumps we need to decode
-    return orjson.dumps(v, default=default).decode()
+    # used as pydantic json_dumps. orjson.dumps returns bytes, to match standard json.dumps we need to decode
+    return orjson.dumps(v, default=default, option=ORJSON_DUMP_OPTION).decode()
 
 
 def get_abs_path(rel_filepath: str):
@@ -56,12 +77,20 @@ class JSONPath(pathlib.PosixPath):
         super().__init__()
         # todo could also have a flag if no error. which makes it safer to use (prevent overwrite)
 
-        if not isfile(self.as_posix()) and raise_error:
+        # the suffix check is free, the file check only done when needed
+        if self.suffix != ".json":
+            raise ValueError(self.as_posix())
+        if raise_error and not isfile(self.as_posix()):
             raise FileNotFoundError(
                 f"Missing file: {self.relative_to(BASE_DATA_FOLDER)}"
             )
-        if self.suffix != ".json":
-            raise ValueError(self.as_posix())
+
+    @classmethod
+    def for_write(cls, *args) -> "JSONPath":
+        """
+        path of a file, that is written and might not exist yet. does not check the file
+        """
+        return cls(*args, raise_error=False)
 
     # noinspection PyDefaultArgument
     def read(self, setdefault: dict = {}) -> dict:
@@ -133,6 +162,15 @@ class JSONPath(pathlib.PosixPath):
             write_json(data, self.as_posix(), True)
 
 
+@lru_cache(maxsize=128)
+def _sniff_csv_dialect(file_path: str, mtime_ns: int) -> Type[csv.Dialect]:
+    """
+    dialect of a csv file, sniffed from its beginning. cached as long as the file is not modified
+    """
+    with open(file_path, encoding="utf-8") as fin:
+        return csv.Sniffer().sniff(fin.read(1024))
+
+
 class CSVPath(pathlib.PosixPath):
     def __init__(self, *args, **kwargs):
         """
@@ -143,21 +181,35 @@ class CSVPath(pathlib.PosixPath):
         """
         super().__init__()
         # todo could also have a flag if no error. which makes it safer to use (prevent overwrite)
-        if not isfile(self.as_posix()) and kwargs.get("raise_error", True):
-            raise FileNotFoundError(self.as_posix())
         if self.suffix != ".csv":
             raise ValueError(self.as_posix())
+        if kwargs.get("raise_error", True) and not isfile(self.as_posix()):
+            raise FileNotFoundError(self.as_posix())
+
+    @classmethod
+    def for_write(cls, *args) -> "CSVPath":
+        """
+        path of a file, that is written and might not exist yet. does not check the file
+        """
+        return cls(*args, raise_error=False)
 
-    def read(self, as_dict: bool = False, to_list: bool = False) -> Union[DictReader, _csv.reader, list]:
-        fin = open(self.as_posix(), encoding="utf-8")
-        dialect = csv.Sniffer().sniff(fin.read(1024))
-        fin.seek(0)
+    def read(self, as_dict: bool = False, to_list: bool = False, buffering: int = -1) -> Union[
+        DictReader, _csv.reader, list]:
+        """
+        @param as_dict: DictReader instead of reader
+        @param to_list: read all rows into a list
+        @param buffering: buffer size for open, -1 for the default
+        """
+        file_path = self.as_posix()
+        dialect = _sniff_csv_dialect(file_path, os.stat(file_path).st_mtime_ns)
+        fin = open(file_path, encoding="utf-8", buffering=buffering)
         if as_dict:
             reader = csv.DictReader(fin, dialect=dialect)
         else:
             reader = csv.reader(fin, dialect)
         if to_list:
-            return list(reader)
+            with fin:
+                return list(reader)
         else:
             return reader
 
@@ -178,30 +230,44 @@ def glob_json(path_: str, filter_underscore: bool = False):
 def open_file(
         rel_filepath: str, binary: bool = False, encoding="utf-8", with_extension=False
 ):
+    """
+    the returned file is not closed here, the caller should use it in a with statement
+    """
     abs_path = get_abs_path(rel_filepath)
 
     if not isfile(abs_path):
         logger.warning(f"WARNING, FILE {abs_path} does not exist")
         return None
     fn, ext = splitext(abs_path)
+    # binary mode does not take an encoding
+    fin = open(abs_path, "rb") if binary else open(abs_path, "r", encoding=encoding)
     if with_extension:
-        return open(abs_path, "r" if not binary else "rb", encoding=encoding), ext
+        return fin, ext
     else:
-        return open(abs_path, "r" if not binary else "rb", encoding=encoding)
+        return fin
 
 
 def read_json(rel_filepath: str) -> dict:
-    return json.load(open_file(rel_filepath))
+    # orjson parses the bytes directly, no decoding needed
+    with open(get_abs_path(rel_filepath), "rb") as fin:
+        return orjson.loads(fin.read())
 
 
 def read_orjson(rel_filepath: str) -> dict:
-    of = open(get_abs_path(rel_filepath), encoding="utf-8")
-    return orjson.loads(of.read())
+    """
+    files of at least MMAP_READ_MIN_SIZE are memory-mapped and parsed without reading them into a bytes object
+    """
+    with open(get_abs_path(rel_filepath), "rb") as fin:
+        if os.fstat(fin.fileno()).st_size < MMAP_READ_MIN_SIZE:
+            return orjson.loads(fin.read())
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as buffer:
+            return orjson.loads(buffer)
 
 
 def write_text(string, rel_filepath):
     abs_path = get_abs_path(rel_filepath)
-    open(abs_path, "w", encoding="utf-8").write(string)
+    with open(abs_path, "w", encoding="utf-8") as fout:
+        fout.write(string)
 
 
 def read_all_orjson(paths: List[str]) -> List[Dict]:
@@ -213,23 +279,18 @@ def read_all_orjson(paths: List[str]) -> List[Dict]:
 # which check for changes
 # and has format var, default: <index>_<date>_<name>
 def write_json(data: Dict, rel_filepath: str, indent: bool = None):
-    json.dump(
-        data,
-        open(get_abs_path(rel_filepath), "w", encoding="utf-8"),
-        indent=2 if indent else 0,
-        ensure_ascii=False,
-    )
+    with open(get_abs_path(rel_filepath), "wb") as fout:
+        fout.write(orjson.dumps(data, option=ORJSON_DUMP_OPTION_INDENT if indent else ORJSON_DUMP_OPTION))
 
 
 def write_orjson(data, rel_filepath, indent: int = 0):
     abs_path = get_abs_path(rel_filepath)
     os.makedirs(Path(abs_path).parent.as_posix(), exist_ok=True)
-    fout = open(abs_path, "w", encoding="utf-8")
-    if not indent:
-        fout.write(orjson.dumps(data).decode("utf-8"))
-    else:
-        fout.write(json.dumps(data, indent=2, ensure_ascii=False))
-    fout.close()
+    with open(abs_path, "wb") as fout:
+        if not indent:
+            fout.write(orjson.dumps(data, option=ORJSON_DUMP_OPTION))
+        else:
+            fout.write(orjson.dumps(data, option=ORJSON_DUMP_OPTION_INDENT))
 
 
 def create_version_path(
@@ -248,6 +309,14 @@ def create_version_path(
     )
 
 
+# per folder of versioned files: id -> latest version
+VERSIONS_MANIFEST = "_versions.json"
+# sorted keys, so equal data gives equal bytes
+_CANONICAL_OPTION = ORJSON_DUMP_OPTION | orjson.OPT_SORT_KEYS
+# held while a new version is determined and written, and while a manifest is updated
+_versioning_lock = threading.RLock()
+
+
 def get_latest_path(id: str, rel_filepath: str, format: str = "json"):
     return rel_filepath + "/_latest_" + id + "." + format
 
@@ -256,12 +325,61 @@ def get_latest(id: str, rel_filepath: str, format: str = "json") -> str:
     return glob(get_latest_path(id, rel_filepath, format))
 
 
+def get_versions_manifest(rel_filepath: str) -> Optional[Dict[str, int]]:
+    """
+    the manifest of a folder with versioned files: id -> latest version. None if there is none.
+    """
+    try:
+        return read_orjson(get_abs_path(join(rel_filepath, VERSIONS_MANIFEST)))
+    except FileNotFoundError:
+        return None
+
+
+def set_manifest_version(id: str, rel_filepath: str, version: int):
+    """
+    sets the latest version of id in the folders manifest. the manifest is replaced atomically
+    """
+    manifest_path = get_abs_path(join(rel_filepath, VERSIONS_MANIFEST))
+    with _versioning_lock:
+        manifest = get_versions_manifest(rel_filepath) or {}
+        manifest[id] = version
+        fd, temp_path = mkstemp(dir=os.path.dirname(manifest_path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(orjson.dumps(manifest))
+            os.replace(temp_path, manifest_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
 def get_latest_version_number(id: str, rel_filepath: str, format: str = "json"):
+    if (manifest := get_versions_manifest(rel_filepath)) and id in manifest:
+        return manifest[id]
+    return get_latest_version_number_from_files(id, rel_filepath, format)
+
+
+def get_latest_version_number_from_files(id: str, rel_filepath: str, format: str = "json"):
+    """
+    the highest version in the filenames of the versions of id
+    """
     all_files = glob(rel_filepath + "/*_*_" + id + "." + format)
-    all_files = filter(lambda f: basename(f).split("_")[1] != "latest", all_files)
-    if not all_files:
-        return 0
-    return max(int(basename(f).split("_")[1]) for f in all_files)
+    return max((int(version) for version in (basename(f).split("_")[1] for f in all_files)
+                if version != "latest"), default=0)
+
+
+def replace_with_copy(src: str, dst: str):
+    """
+    replaces dst atomically with a copy of src. a copy, not a hardlink, so writing dst never changes src
+    """
+    fd, temp_path = mkstemp(dir=os.path.dirname(dst), suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copyfile(src, temp_path)
+        os.replace(temp_path, dst)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
 
 
 def write_versioned_json(
@@ -272,6 +390,12 @@ def write_versioned_json(
         exclude_paths: set = None,
         log_diff: bool = False,
 ):
+    # the next version is determined and written by one writer at a time
+    with _versioning_lock:
+        _write_versioned_json(data, id, rel_filepath, indent, exclude_paths)
+
+
+def _write_versioned_json(data: dict, id: str, rel_filepath: str, indent: Optional[int], exclude_paths: Optional[set]):
     latest_path = get_latest_path(id, rel_filepath)
 
     write_latest = False
@@ -280,9 +404,17 @@ def write_versioned_json(
     if isfile(latest_path):
         last_version_data = read_json(latest_path)
         next_version = 1 + get_latest_version_number(id, rel_filepath)
-        data_diff = DeepDiff(data, last_version_data, exclude_paths)
-        if data_diff:
-            write_latest = True
+        # unchanged data (the common case) is detected on the canonical bytes, without diffing
+        try:
+            unchanged = orjson.dumps(data, option=_CANONICAL_OPTION) == orjson.dumps(last_version_data,
+                                                                                   option=_CANONICAL_OPTION)
+        except TypeError:
+            # not json serializable (e.g. sets), so only DeepDiff can compare it
+            unchanged = False
+        if not unchanged:
+            data_diff = DeepDiff(data, last_version_data, exclude_paths)
+            if data_diff:
+                write_latest = True
         print("has latest")
     else:
         print("has no latest")
@@ -291,15 +423,21 @@ def write_versioned_json(
 
     if write_latest:
         print("writing latest")
-        write_json(data, latest_path, indent)
         next_version_path = create_version_path(id, rel_filepath, next_version)
-        shutil.copy(latest_path, next_version_path)
+        if isfile(get_abs_path(next_version_path)):
+            # the manifest is behind the files, never overwrite an existing version
+            logger.warning(f"versions manifest of {rel_filepath} is outdated for {id}")
+            next_version = 1 + get_latest_version_number_from_files(id, rel_filepath)
+            next_version_path = create_version_path(id, rel_filepath, next_version)
+        write_json(data, next_version_path, indent)
+        replace_with_copy(get_abs_path(next_version_path), get_abs_path(latest_path))
         if data_diff:
             print("writing diff")
             next_version_diff_path = create_version_path(
                 id, rel_filepath, next_version, "diff.json"
             )
             write_json(data_diff, next_version_diff_path, indent)
+        set_manifest_version(id, rel_filepath, next_version)
 
 
 def guarantee_path(path, get_abs):
@@ -315,26 +453,18 @@ def simple_timestring(dt: datetime):
 
 #  not used atm but maybe later...
 _filename_ascii_strip_re = re.compile(r"[^A-Za-z0-9_.-]")
+# path separators become spaces (and then underscores)
+_filename_sep_table = str.maketrans({sep: " " for sep in (path.sep, path.altsep) if sep})
 
 
-def secure_filename(filename):
+def secure_filename(filename: str) -> str:
     """Pass it a filename and it will return a secure version of it
     from https://github.com/pallets/werkzeug/blob/master/src/werkzeug/utils.py
     :param filename: the filename to secure
     """
-    if isinstance(filename, str):
-        from unicodedata import normalize
-
-        filename = normalize("NFKD", filename).encode("ascii", "ignore")
-
-    for sep in path.sep, path.altsep:
-        if sep:
-            filename = filename.replace(sep, " ")
-    filename = str(_filename_ascii_strip_re.sub("", "_".join(filename.split()))).strip(
-        "._"
-    )
-
-    return filename
+    filename = normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+    filename = filename.translate(_filename_sep_table)
+    return _filename_ascii_strip_re.sub("", "_".join(filename.split())).strip("._")
 
 
 # noinspection PyDefaultArgument
@@ -366,36 +496,47 @@ def dict_reader_guess_delimiter(file):
     if not isfile(file):
         print("invalid path", file)
         return None
+    # probe the delimiters on the header, read only once
+    with open(file, "rb") as fin:
+        head = fin.read(8192).decode("utf-8", "ignore")
     for delim in [",", ";"]:
-        reader = DictReader(
-            open(file, encoding="utf-8"), delimiter=delim, quotechar='"'
-        )
-        if len(reader.fieldnames) > 1:
-            return reader
+        header = next(csv.reader(io.StringIO(head), delimiter=delim, quotechar='"'), [])
+        if len(header) > 1:
+            return DictReader(
+                open(file, encoding="utf-8"), delimiter=delim, quotechar='"'
+            )
 
 
 @deprecated(reason="Use util.files.frictionless_extract")
 async def transform_spooledfile2csv(file: IO) -> List[Sequence[str]]:
-    init_text = file.read()
-    encoding = chardet.detect(init_text)
-    dialect = csv.Sniffer().sniff(init_text.decode(encoding["encoding"]))
+    # detect the encoding incrementally, usually the first chunk is enough
+    detector = UniversalDetector()
+    first_chunk = file.read(UPLOAD_CHUNK_SIZE)
+    chunk = first_chunk
+    while chunk and not detector.done:
+        detector.feed(chunk)
+        chunk = file.read(UPLOAD_CHUNK_SIZE)
+    encoding = detector.close()
+    dialect = csv.Sniffer().sniff(first_chunk.decode(encoding["encoding"], "ignore"))
     # logger.warning(encoding)
     # logger.warning(dialect.__dict__)
     file.seek(0)
-    # write it to a temporary file
-    lines = [l for l in file.readlines()]
+    temp = None
     try:
+        # write it to a temporary file
         temp = NamedTemporaryFile("wb", -1, delete=False)
-        temp.writelines(lines)
+        shutil.copyfileobj(file, temp, UPLOAD_CHUNK_SIZE)
         temp.close()
         # reopen file, (now with the dialect it should be clean)
         # clean header & empty cells
-        lines = list(csv.reader(open(temp.name, encoding="utf-8"), dialect=dialect))
+        with open(temp.name, encoding="utf-8") as fin:
+            lines = list(csv.reader(fin, dialect=dialect))
     # delete
     except Exception:
         lines = []
     finally:
-        await aiofiles.os.remove(temp.name)
+        if temp:
+            await asyncio.to_thread(os.unlink, temp.name)
     return lines
 
 
@@ -403,7 +544,7 @@ async def frictionless_extract(file: IO):
     new_name = None
     try:
         temp = NamedTemporaryFile("wb", -1, delete=False)
-        temp.write(file.read())
+        shutil.copyfileobj(file, temp, UPLOAD_CHUNK_SIZE)
         temp.close()
         new_name = temp.name + ".csv"
         shutil.move(temp.name, new_name)
@@ -413,7 +554,7 @@ async def frictionless_extract(file: IO):
         data = []
     finally:
         if new_name:
-            await async_remove(new_name)
+            await asyncio.to_thread(os.unlink, new_name)
     return data
 
 
@@ -432,14 +573,24 @@ async def create_temp_csv(columns, rows) -> NamedTemporaryFile:
 
 
 async def zip_files(
-        filename: str, files: List[Tuple[NamedTemporaryFile, str]]
+        filename: str, files: List[Tuple[Union[NamedTemporaryFile, bytes], str]]
 ) -> zipfile.ZipFile:
+    """
+    @param filename: name of the zip file in TEMP_APP_FILES
+    @param files: (temp-file or in memory bytes, name in the archive)
+    """
     zip_file = zipfile.ZipFile(
-        join(TEMP_APP_FILES, filename), "w", zipfile.ZIP_DEFLATED
+        join(TEMP_APP_FILES, filename), "w", zipfile.ZIP_DEFLATED, allowZip64=True,
+        compresslevel=ZIP_COMPRESS_LEVEL
     )
-    for file, filename in files:
-        file.close()
-        zip_file.write(file.name, filename)
+    for file, arcname in files:
+        # compressing already compressed files just costs time
+        compress_type = zipfile.ZIP_STORED if splitext(arcname)[1].lower() in COMPRESSED_SUFFIXES else None
+        if isinstance(file, bytes):
+            zip_file.writestr(arcname, file, compress_type)
+        else:
+            file.close()
+            zip_file.write(file.name, arcname, compress_type)
 
     zip_file.close()
     return zip_file
@@ -449,9 +600,16 @@ def remove_last_empty_column(data: List[List[str]]) -> List[List[str]]:
     """
     some csvs come with an additional empty column... kick em out
     """
-    empty_indices = [i for i, row in enumerate(data[0]) if not row]
-    if empty_indices:
-        for row in data:
-            for i in empty_indices:
-                del row[i]
+    if not data:
+        return data
+    keep = [i for i, header in enumerate(data[0]) if header]
+    num_columns = len(data[0])
+    if len(keep) < num_columns:
+        # rebuild the rows from the kept columns, instead of shifting them with del. cells beyond the header stay
+        data[:] = [
+            [row[i] for i in keep] + row[num_columns:]
+            if len(row) >= num_columns
+            else [row[i] for i in keep if i < len(row)]
+            for row in data
+        ]
     return data
@@ -1,4 +1,4 @@
-import re
+from itertools import islice
 from logging import getLogger
 from typing import List, Tuple
 
@@ -25,39 +25,32 @@ def table_col2dict(cols: List[Tuple[str, str]]) -> dict:
     """
     result = {}
     for col in cols:  # index, msg
-        # print("col", col)
         act = result
         split_loc: List[str] = col[0].split(".")
-        last_index: int = len(split_loc) - 1
         act_is_list = False
-        for index, loc in enumerate(split_loc):
-            # print(index, loc, act, act_is_list)
-            if index == last_index:
+        # each part decides by the following part, whether it holds a list (next is a number) or a dict
+        for loc, next_loc in zip(split_loc, islice(split_loc, 1, None)):
+            if next_loc.isdecimal():
+                act_index: int = int(next_loc)
                 if act_is_list:
-                    act.append(col[1])
+                    act.append(act := [])
                 else:
-                    act[loc] = col[1]
+                    act = act.setdefault(loc, [])
+                act_is_list = True
             else:
-                index_part = split_loc[index + 1]
-                if re.match("\d*$", index_part):
-                    act_index: int = int(index_part)
-                    if act_is_list:
-                        act.append(act := [])
+                if act_is_list:
+                    # todo this doesnt seem right. but it works at. not sure how if there would be 2 list after each other
+                    if act_index >= len(act):
+                        act.append(act := {})
                     else:
-                        act = act.setdefault(loc, [])
-                    act_is_list = True
+                        act = act[act_index]
                 else:
-                    if act_is_list:
-                        # logger.warning(f"the problematic branch of table_col2dict has been entered, {act}, {act_index} {act_index >= len(act)}")
-                        # todo this doesnt seem right. but it works at. not sure how if there would be 2 list after each other
-
-                        if act_index >= len(act):
-                            act.append(act := {})
-                        else:
-                            act = act[act_index]
-                    else:
-                        act = act.setdefault(loc, {})
-                    act_is_list = False
+                    act = act.setdefault(loc, {})
+                act_is_list = False
+        if act_is_list:
+            act.append(col[1])
+        else:
+            act[split_loc[-1]] = col[1]
     return result
 
 
@@ -11,11 +11,10 @@ def set_visible_location(
     entry: Union[EntryMeta, MapEntry, Dict], db_obj: Entry, actor: RegisteredActor
 ):
     if db_obj.location and not db_obj.protected_read_access(actor):
-        new_loc = []
-        for loc in db_obj.location:
-            new_loc.append(only_public_location(loc))
+        # same as only_public_location, inlined
+        new_loc = [loc.get("public_loc", loc) for loc in db_obj.location]
         # print(entry.location)
-        if type(entry) == dict:
+        if isinstance(entry, dict):
             entry["location"] = new_loc
         else:
             entry.location = new_loc
@@ -11,11 +11,12 @@ def fix_constructed_entry_actors(
     """
 
     def construct_ear(ear_data: dict):
-        return EntryActorRelationOut(
+        # the entry data is constructed without validation anyway
+        return EntryActorRelationOut.construct(
             actor=ActorBase.construct(**ear_data["actor"]), role=ear_data["role"]
         )
 
     return [
-        a_r if type(a_r) == EntryActorRelationOut else construct_ear(a_r)
+        a_r if isinstance(a_r, EntryActorRelationOut) else construct_ear(a_r)
         for a_r in entry_actors
     ]
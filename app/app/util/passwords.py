@@ -1,19 +1,64 @@
+import hashlib
+import hmac
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
 from uuid import uuid4
 
-from passlib import pwd
 from passlib.context import CryptContext
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# successful login verifications are remembered for a while, so repeated logins dont run bcrypt each time.
+# keys are hmacs with a per-process secret, plain passwords are not kept
+VERIFIED_CACHE_MAXSIZE = 4096
+VERIFIED_CACHE_TTL = 300  # seconds
+_verified_cache_secret = os.urandom(32)
+_verified_cache: "OrderedDict[bytes, float]" = OrderedDict()
+_verified_cache_lock = threading.Lock()
+
 
 def generate_access_token():
-    return pwd.genword(entropy=56, length=32)
+    # 32 hex chars from os.urandom
+    return uuid4().hex
+
+
+def _verified_cache_key(plain_password: str, hashed_password: str) -> bytes:
+    return hmac.new(
+        _verified_cache_secret,
+        f"{plain_password}\0{hashed_password}".encode("utf-8"),
+        hashlib.sha256,
+    ).digest()
 
 
 def verify_hash(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 
+def verify_login_hash(plain_password, hashed_password):
+    """
+    verify_hash for the login, successful verifications are cached (VERIFIED_CACHE_TTL).
+    only for the login, other checks (password change, verification and reset codes) use verify_hash
+    """
+    key = _verified_cache_key(plain_password, hashed_password)
+    now = monotonic()
+    with _verified_cache_lock:
+        if (expires := _verified_cache.get(key)) is not None:
+            if expires > now:
+                _verified_cache.move_to_end(key)
+                return True
+            del _verified_cache[key]
+    verified = pwd_context.verify(plain_password, hashed_password)
+    if verified:
+        with _verified_cache_lock:
+            _verified_cache[key] = now + VERIFIED_CACHE_TTL
+            _verified_cache.move_to_end(key)
+            if len(_verified_cache) > VERIFIED_CACHE_MAXSIZE:
+                _verified_cache.popitem(last=False)
+    return verified
+
+
 def create_hash(password):
     return pwd_context.hash(password)
 
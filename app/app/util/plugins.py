@@ -1,14 +1,14 @@
 from logging import getLogger
 from os.path import basename
-from typing import Dict, Optional, Tuple, TYPE_CHECKING
-from collections import namedtuple
+from typing import Dict, Optional, Tuple, TYPE_CHECKING, NamedTuple, Type
 from app.globals import available_plugins, registered_plugins
 from app.models.orm import RegisteredActor, Entry
 from app.util.exceptions import ApplicationException
 
-AvailablePlugin = namedtuple(
-    "Available_plugins_struct", ["class_name", "clazz", "plugin_path"]
-)
+class AvailablePlugin(NamedTuple):
+    class_name: str
+    clazz: Type
+    plugin_path: str
 
 logger = getLogger(__name__)
 
@@ -46,7 +46,10 @@ def activate_plugin(plugin_name: str) -> bool:
         logger.warning(f"Plugin with name {plugin_name} already hooked up")
         return False
 
-    plugin_clazz_name, plugin_clazz, plugin_path = available_plugins.get(plugin_name)
+    if (available_plugin := available_plugins.get(plugin_name)) is None:
+        logger.warning(f"No plugin with name {plugin_name} available")
+        return False
+    plugin_clazz_name, plugin_clazz, plugin_path = available_plugin
     try:
         logger.debug(f"creating plugin object {plugin_clazz_name}")
         plugin_obj = plugin_clazz()
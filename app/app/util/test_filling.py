@@ -1,23 +1,29 @@
+from passlib.context import CryptContext
+
 from app.models.orm import RegisteredActor
 from app.util.consts import USER
-from app.util.passwords import create_hash
+
+# dummies are test accounts, so their hashes use the minimal bcrypt cost.
+# the regular context verifies them anyway, since the rounds are stored in the hash
+_dummy_pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4)
 
 
 def add_dummy_actors(session, num):
-    for i in range(1, num + 1):
-        n = "dummy" + str(i)
-        exists = (
-            session.query(RegisteredActor)
-            .filter(RegisteredActor.registered_name == n)
-            .one_or_none()
+    names = ["dummy" + str(i) for i in range(1, num + 1)]
+    existing = {
+        name
+        for (name,) in session.query(RegisteredActor.registered_name).filter(
+            RegisteredActor.registered_name.in_(names)
         )
-        if not exists:
+    }
+    for n in names:
+        if n not in existing:
             # noinspection PyArgumentList
             dummy = RegisteredActor(
                 registered_name=n,
                 email=n + "@uab.cat",
                 public_name=n,
-                hashed_password=create_hash(n),
+                hashed_password=_dummy_pwd_context.hash(n),
                 global_role=USER,
             )
             session.add(dummy)
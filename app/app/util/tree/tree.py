@@ -1,18 +1,31 @@
+from collections import defaultdict
 from dataclasses import dataclass, field
 from logging import DEBUG, getLogger
-from typing import Dict, List, Optional, Union
+from typing import Dict, FrozenSet, List, Optional, Tuple, Union
 
+from app.util.common import DATACLASS_SLOTS
 from app.util.consts import VALUE, TEXT
 
 logger = getLogger(__name__)
 logger.setLevel(DEBUG)
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class Tree:
     levels: List[str]
     root: Optional["TreeNode"] = None
     description: Optional[str] = None
+    # level name -> level (root: 0), for the levels given as names.
+    # set on construction, levels are not changed after that
+    _level_index: Dict[str, int] = field(default_factory=dict, repr=False, compare=False)
+    # on_levels of tree_find_duplicate -> the levels as ints
+    _on_levels_cache: Dict[Tuple, FrozenSet[int]] = field(default_factory=dict, repr=False, compare=False)
+
+    def __post_init__(self):
+        # like self.levels.index(name) + 1. levels which are not names (e.g. dicts) cannot match a name
+        for index, level in enumerate(self.levels):
+            if isinstance(level, str):
+                self._level_index.setdefault(level, index + 1)
 
     @staticmethod
     def from_dict(data: Dict):
@@ -38,37 +51,40 @@ class Tree:
         self, on_levels: Optional[List[Union[int, str]]] = None
     ) -> Dict[str, List["TreeNode"]]:
 
-        value_dict: Dict = {}
-
+        levels_set = self._get_on_levels(on_levels)
+
+        value_dict: Dict[str, List[TreeNode]] = defaultdict(list)
+        # depth first, children reversed to keep the order of the nodes
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if not levels_set or node.get_level() in levels_set:
+                value_dict[node.value].append(node)
+            stack.extend(reversed(node.children))
+        return dict(value_dict)
+
+    def _get_on_levels(self, on_levels: Optional[List[Union[int, str]]]) -> FrozenSet[int]:
+        """
+        converts the level names of on_levels to ints. cached per on_levels
+        """
+        if not on_levels:
+            return frozenset()
+        key = tuple(on_levels)
+        if (levels_set := self._on_levels_cache.get(key)) is not None:
+            return levels_set
         new_on_level: List[int] = []
         for lvl in on_levels:
             if type(lvl) == int:
                 new_on_level.append(lvl)
+            elif (index := self._level_index.get(lvl)) is not None:
+                new_on_level.append(index)
             else:
-                if lvl in self.levels:
-                    new_on_level.append(self.levels.index(lvl) + 1)
-                else:
-                    logger.warning(
-                        "trying to get duplicates on level that is not in the tree"
-                    )
-
-        on_levels = new_on_level
-        # print("on levels:", on_levels)
-        logger.info("on levels: %s", on_levels)
-
-        def rec_find_duplicates(node: TreeNode):
-            # print(node.value, node.get_level())
-            logger.debug(node.value, node.get_level())
-            if not on_levels or node.get_level() in on_levels:
-                # print(node.value, "?")
-                nodes: List[TreeNode] = value_dict.setdefault(node.value, [])
-                nodes.append(node)
-            # print(value_dict[node.value])
-            for k in node.children:
-                rec_find_duplicates(k)
-
-        rec_find_duplicates(self.root)
-        return {k: v for (k, v) in value_dict.items()}
+                logger.warning(
+                    "trying to get duplicates on level that is not in the tree"
+                )
+        logger.info("on levels: %s", new_on_level)
+        levels_set = self._on_levels_cache[key] = frozenset(new_on_level)
+        return levels_set
 
     def dumps(self):
         data = {
@@ -81,7 +97,7 @@ class Tree:
         return data
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class TreeNode:
     tree: Optional[Tree]
     parent: Optional["TreeNode"] = None
@@ -93,70 +109,94 @@ class TreeNode:
     description: Optional[str] = None
     icon: Optional[str] = None
     extra: Optional[Dict] = None
+    # depth in the tree (root: 0), set on construction. trees are not restructured after that
+    _level: int = field(default=0, repr=False, compare=False)
+    # entry of the level in tree.levels, set by get_level_value
+    _level_value: Optional[str] = field(default=None, repr=False, compare=False)
 
     @staticmethod
     def from_dict(
         data: Dict, tree: Optional[Tree], parent: Optional["TreeNode"]
     ) -> "TreeNode":
-        node = TreeNode(tree=tree, parent=parent)
+        node = TreeNode._node_from_dict(data, tree, parent)
+        # (data, node) pairs, whose children still need to be created
+        stack = [(data, node)]
+        while stack:
+            act_data, act = stack.pop()
+            for kid_data in act_data.get("children", []):
+                kid = TreeNode._node_from_dict(kid_data, tree, act)
+                act.children.append(kid)
+                stack.append((kid_data, kid))
+        return node
+
+    @staticmethod
+    def _node_from_dict(
+        data: Dict, tree: Optional[Tree], parent: Optional["TreeNode"]
+    ) -> "TreeNode":
+        """
+        the node without its children
+        """
+        node = TreeNode(tree=tree, parent=parent, _level=parent._level + 1 if parent else 0)
         if value := data.get(VALUE):
             node.value = value
         if text := data.get(TEXT):
             node.text = text
-        node.tree = tree
-        if parent:
-            node.parent = parent
-
-        for kid in data.get("children", []):
-            node.children.append(TreeNode.from_dict(kid, tree, node))
-
-        # print(data.get("code"))
         for d in ["tag", "description", "code", "icon", "extra"]:
             if d in data:
                 setattr(node, d, data[d])
-
         return node
 
     def get_level(self) -> int:
-        def rec_parent_lvl(node: TreeNode, level: int = 0):
-            if node.parent:
-                return rec_parent_lvl(node.parent, level + 1)
-            else:
-                return level
-
-        return rec_parent_lvl(self)
+        return self._level
 
     def get_level_value(self) -> str:
-        return self.tree.levels[self.get_level()]
+        if self._level_value is None:
+            self._level_value = self.tree.levels[self._level]
+        return self._level_value
 
     def get_branch(
         self, include_root: bool = False, include_self=True
     ) -> List["TreeNode"]:
-        def rec_parent(node: TreeNode):
-
-            if node.parent:
-                if include_self and node is self or node is not self:
-                    return rec_parent(node.parent) + [node]
-                else:
-                    return rec_parent(node.parent) + []
-            else:
-                if include_root:
-                    return [node]
-                else:
-                    return []
-
-        return rec_parent(self)
+        branch = []
+        node = self
+        while node.parent:
+            if include_self or node is not self:
+                branch.append(node)
+            node = node.parent
+        # node is the root now
+        if include_root:
+            branch.append(node)
+        branch.reverse()
+        return branch
 
     def __repr__(self):
         return f"{self.value}, {self.tag} , {len(self.children)}"
 
     def dumps(self):
+        data = self._dump_attrs()
+        # (node, data) pairs, whose children still need to be dumped
+        stack = [(self, data)]
+        while stack:
+            node, node_data = stack.pop()
+            if node.children:
+                kids_data = []
+                for kid in node.children:
+                    kid_data = kid._dump_attrs()
+                    kids_data.append(kid_data)
+                    stack.append((kid, kid_data))
+                node_data["children"] = kids_data
+        return data
+
+    def _dump_attrs(self) -> Dict:
+        """
+        the set attributes of the node, without its children
+        """
         data = {}
-        for d in ["value", "text", "tag", "code", "description", "icon", "extra"]:
-            if getattr(self, d):
-                data[d] = getattr(self, d)
+        for d in _DUMP_ATTRS:
+            if val := getattr(self, d):
+                data[d] = val
+        return data
 
-        if self.children:
-            data["children"] = list(k.dumps() for k in self.children)
 
-        return data
+_DUMP_ATTRS = ("value", "text", "tag", "code", "description", "icon", "extra")
+
@@ -1,16 +1,15 @@
 import csv
-import json
 import os
-from copy import deepcopy, copy
-from csv import DictWriter
+from copy import deepcopy
 from pathlib import Path
-from typing import Callable, List, Dict, Optional, Tuple, Union, Any
+from typing import Callable, List, Dict, Optional, Tuple, Union, Any, Sequence, Iterator
 
+import orjson
 from fastapi import UploadFile
 
 from app.models.schema.aspect_models import AspectBaseIn, AspectMerge
 from app.util.consts import VALUE, TEXT, DESCRIPTION
-from app.util.files import dict_reader_guess_delimiter
+from app.util.files import dict_reader_guess_delimiter, ORJSON_DUMP_OPTION
 from app.util.tree.tree import Tree
 
 base_fields = [VALUE, "icon", "tag", "children", "extra"]
@@ -20,24 +19,31 @@ CHILDREN = "children"
 
 
 def recursive_transform(
-        root: dict, func: Callable[[Dict, List[Dict], List[int], Any], Optional[bool]],
+        root: dict, func: Callable[[Dict, Sequence[Dict], Sequence[int], Any], Optional[bool]],
         ignore_root: bool = False,
+        copy_root: bool = True,
         **kwargs
 ) -> dict:
-    new_root = deepcopy(root)
-
-    # noinspection PyDefaultArgument
-    def rec_handle(node: dict, parents: List[dict] = [], indices: List[int] = [], **kwargs) -> Optional[bool]:
+    """
+    calls func on all nodes (depth first) until it returns True.
+    func gets the node, the tuples of its parents and of its child-indices and the kwargs
+    @param copy_root: work on a deepcopy of root. if False, func must not modify the nodes
+    @return: the (copied) root
+    """
+    new_root = deepcopy(root) if copy_root else root
+    # (node, parents, indices). children are pushed reversed, to be handled in order
+    stack: List[Tuple[dict, Tuple[dict, ...], Tuple[int, ...]]] = [(new_root, (), ())]
+    while stack:
+        node, parents, indices = stack.pop()
         if not ignore_root or parents:
             # noinspection PyArgumentList
-            cancel = func(node, parents, indices, **kwargs)
-            if cancel:
-                return True
-        for index, child in enumerate(node.get(CHILDREN, [])):
-            cancel = rec_handle(child, parents + [node], indices + [index], **kwargs)
-            if cancel:
-                return True
-    rec_handle(new_root, **kwargs)
+            if func(node, parents, indices, **kwargs):
+                break
+        children = node.get(CHILDREN)
+        if children:
+            child_parents = parents + (node,)
+            stack.extend((children[index], child_parents, indices + (index,))
+                         for index in range(len(children) - 1, -1, -1))
     return new_root
 
 
@@ -49,41 +55,42 @@ def all_attr_keys(node: dict, exclude: List[str] = []) -> List[str]:
 def check_unique_values(
         tree, check_keys: List[str], ignore_empty: bool = True
 ) -> Dict[str, List[str]]:  # only_on_level = False,
-
+    """
+    finds values, that appear more than once in the tree (for each of the keys)
+    @return: key: the values that appear again (once for each repetition)
+    """
     values = {k: set() for k in check_keys}  # key: key, value: set
     duplicates = {k: [] for k in check_keys}
-
-    def check_unique(node: dict, parents, **kwargs):
-        # print(kwargs)
+    # children are pushed reversed, to be handled in order
+    stack = [tree]
+    while stack:
+        node = stack.pop()
         for key in check_keys:
             value = node.get(key)
             if not value and ignore_empty:
                 continue
-            if value in kwargs["values"][key]:
-                kwargs["duplicates"][key].append(value)
-            kwargs["values"][key].add(value)
-
-    # WOULD NEED indices
-    recursive_transform(tree, check_unique, values=values, duplicates=duplicates)
+            if value in values[key]:
+                duplicates[key].append(value)
+            else:
+                values[key].add(value)
+        stack.extend(reversed(node.get(CHILDREN, ())))
     return duplicates
 
 
 def flatten(tree: dict, keys: List[str], ignore_empty: bool = True) -> List[List]:
+    """
+    the values of the keys of all nodes (depth first, without the root)
+    @param ignore_empty: leave out values that are None
+    """
     all_nodes = []
-
-    def collect(node, parents, **kwargs):
-        res = []
-        for k in keys:
-            val = node.get(k)
-            if val is None and kwargs["ignore_empty"]:
-                continue
-            res.append(val)
-        kwargs["all_nodes"].append(res)
-
-    # WOULD NEED indices
-    recursive_transform(
-        tree, collect, True, all_nodes=all_nodes, ignore_empty=ignore_empty
-    )
+    stack = list(reversed(tree.get(CHILDREN, ())))
+    while stack:
+        node = stack.pop()
+        if ignore_empty:
+            all_nodes.append([val for val in (node.get(k) for k in keys) if val is not None])
+        else:
+            all_nodes.append([node.get(k) for k in keys])
+        stack.extend(reversed(node.get(CHILDREN, ())))
     return all_nodes
 
 
@@ -102,19 +109,14 @@ def get_path(root, indices=[], include_root: bool = False):
     if include_root:
         res.append(act)
     for ind in indices:
-        try:
-            act = act.get(CHILDREN, [])[ind]
-        except IndexError:
-            print(f"{ind}, but max index: {len(act.get('children', []))}")
-            raise
+        kids = act.get(CHILDREN, ())
+        if not -len(kids) <= ind < len(kids):
+            raise IndexError(f"{ind}, but max index: {len(kids)}")
+        act = kids[ind]
         res.append(act)
 
-    res = deepcopy(res)
-    for n in res:
-        if CHILDREN in n:
-            del n[CHILDREN]
-
-    return res
+    # copies without the children, only the (small) non-str values like extra need a deepcopy
+    return [{k: v if isinstance(v, str) else deepcopy(v) for k, v in n.items() if k != CHILDREN} for n in res]
 
 
 def tree2csv(tree: dict, output_file_path: Optional[Path] = None,
@@ -137,7 +139,8 @@ def tree2csv(tree: dict, output_file_path: Optional[Path] = None,
     assert levels and root
     # create a list of all levels and add the additional_level_columns for each level
     fieldnames = []
-    main_col_names = []
+    # for each level the index of its column and the (key, index) of its additional columns
+    level_columns: List[Tuple[int, List[Tuple[str, int]]]] = []
 
     def additional_columns_for_level(cur_level: str) -> bool:
         # empty list: additional_columns_only_for_levels means we dont have any additional columns
@@ -145,42 +148,48 @@ def tree2csv(tree: dict, output_file_path: Optional[Path] = None,
 
     for level in levels:
         col = level.get(main_column)
+        main_col_index = len(fieldnames)
         fieldnames.append(col)
-        main_col_names.append(col)
+        additional_columns = []
         # if we use additional_columns_only_for_levels, we check if the current level is in the list
         if additional_columns_for_level(col):
             for column in additional_level_columns:
+                additional_columns.append((column, len(fieldnames)))
                 fieldnames.append(f"{col}/{column}")
+        level_columns.append((main_col_index, additional_columns))
 
-    def generate_rows(node: dict, parents: List[dict] = (), indices: List = (), **kwargs):
-        level = len(indices) - 1
-        # print("---")
-        # print(node["value"])
-        # print("kw-current", kwargs["current_row"])
-        # todo validate if enough levels are provided (tree depth corresponds to the the number of levels)
-        main_col_name = main_col_names[level]
-        # ignore root
-        if level >= 0:
-            kwargs["current_row"][main_col_name] = node.get(main_column)
-            if additional_columns_for_level(main_col_name):
-                kwargs["current_row"].update({
-                    **{f"{main_col_name}/{col}": node.get(col) for col in additional_level_columns}
-                })
-            if not node.get(CHILDREN):
-                kwargs["rows"].append(copy(kwargs["current_row"]))
-                kwargs["current_row"].clear()
-
-    rows: List[dict] = []
-    current_row = {}
-    # WOULD NEED indices
-    recursive_transform(root, generate_rows, rows=rows, current_row=current_row)
+    rows = _iter_tree_rows(root, main_column, level_columns, len(fieldnames))
     if output_file_path:
         with open(output_file_path, "w", encoding="utf-8") as output:
-            writer = DictWriter(output, fieldnames)
-            writer.writeheader()
+            writer = csv.writer(output)
+            writer.writerow(fieldnames)
             writer.writerows(rows)
     else:
-        return fieldnames, rows
+        return fieldnames, [dict(zip(fieldnames, row)) for row in rows]
+
+
+def _iter_tree_rows(root: dict, main_column: str, level_columns: List[Tuple[int, List[Tuple[str, int]]]],
+                    num_columns: int) -> Iterator[List[Optional[str]]]:
+    """
+    the rows of tree2csv (depth first), as lists in the order of the columns. a row is completed by a leaf
+    and only contains the columns of the nodes since the previous row, the columns of the parents before are empty
+    """
+    current_row = [""] * num_columns
+    # (node, level). root is level -1 and ignored, children are pushed reversed, to be handled in order
+    stack: List[Tuple[dict, int]] = [(kid, 0) for kid in reversed(root.get(CHILDREN, ()))]
+    while stack:
+        node, level = stack.pop()
+        # todo validate if enough levels are provided (tree depth corresponds to the the number of levels)
+        main_col_index, additional_columns = level_columns[level]
+        current_row[main_col_index] = node.get(main_column)
+        for col, col_index in additional_columns:
+            current_row[col_index] = node.get(col)
+        children = node.get(CHILDREN)
+        if children:
+            stack.extend((kid, level + 1) for kid in reversed(children))
+        else:
+            yield current_row
+            current_row = [""] * num_columns
 
 
 def table2tree(csv_file: UploadFile,
@@ -237,16 +246,20 @@ def table2tree(csv_file: UploadFile,
 
     additional_data_rows = ["description", "icon"]
 
+    # children-lists of the last inserted node of each level (cursors[0] are the children of the root).
+    # None where the last inserted node has no children (list)
+    cursors: List[Optional[list]] = [root[CHILDREN]] + [None] * len(field_names)
+    # nodes, that got a children-list, for remove_empty_children
+    parent_nodes: List[dict] = [root]
+
     def add_at_index(index: int, value, additional_data: Dict, tag: str, row: Dict):
-        act = root[CHILDREN]
-        # print(f"{value} -> {index}")
-        for i in range(index):
-            try:
-                act = act[-1][CHILDREN]
-            except:
-                print(f"failed to insert {value} at index {i}. 'act' is {act}")
-        # print(json.dumps(root, indent=2))
-        # print(i)
+        level = index
+        # malformed tables (levels skipped) insert into the deepest available level
+        while cursors[level] is None:
+            level -= 1
+        act = cursors[level]
+        if level < index:
+            print(f"failed to insert {value} at index {level}. 'act' is {act}")
         if as_base:
             insert = {VALUE: value}
         else:
@@ -268,14 +281,27 @@ def table2tree(csv_file: UploadFile,
         if index < len(field_names) - 1:
             # print("+kids", index, value)
             insert[CHILDREN] = []
+            parent_nodes.append(insert)
         # print(insert)
         act.append(insert)
+        cursors[level + 1] = insert.get(CHILDREN)
+        cursors[level + 2:] = [None] * (len(cursors) - level - 2)
 
     if read_levels:
         levels = next(reader)
     if not as_base:
         values["levels"] = [{"text": levels[field], "description": levels[field + "/description"]} for field in
                             field_names]
+    # the following columns of each column, which are reset when it gets a new value
+    reset_columns = {col: field_names[index + 1:] for index, col in enumerate(field_names)}
+    # (additional key, column name) of the additional columns, that exist for each column
+    additional_columns: Dict[str, List[Tuple[str, str]]] = {
+        col: [(additionals, f"{col}/{additionals}") for additionals in additional_data_rows
+              if additionals in (base_fields if as_base else lang_fields)
+              and f"{col}/{additionals}" in all_field_names]
+        for col in field_names
+    }
+
     for row in reader:
         all_levels_of_row = [row[col].strip() for col in field_names if row[col].strip() != ""]
 
@@ -285,19 +311,12 @@ def table2tree(csv_file: UploadFile,
             if val != columns_act[col] and val.strip() != "":
                 columns_act[col] = val
                 # print("got col", col)
-                for col_name in field_names[field_names.index(col) + 1:]:
+                for col_name in reset_columns[col]:
                     # print("resetting", col_name)
                     columns_act[col_name] = None
                 # here also reset the columns_act of the following columns. so when the same name appears (in one of the following cols)
                 # they are accepts (val != columns_act[col] must pass)
-                additional_data = {}
-                for additionals in additional_data_rows:
-                    if additionals in (base_fields if as_base else lang_fields):
-                        col_name = f"{col}/{additionals}"
-                        # print(col_name)
-                        if col_name in all_field_names:
-                            # print("found")
-                            additional_data[additionals] = row[col_name]
+                additional_data = {additionals: row[col_name] for additionals, col_name in additional_columns[col]}
 
                 tag = None
                 # print(val, val == all_levels_of_row[-1], row.get("tag"))
@@ -308,20 +327,15 @@ def table2tree(csv_file: UploadFile,
                 add_at_index(index, val.strip(), additional_data, tag, row)
 
     if remove_empty_children:
-        def rec_kids_search(node):
-            if CHILDREN in node:
-                if len(node[CHILDREN]) == 0:
-                    del node[CHILDREN]
-                else:
-                    for kid in node[CHILDREN]:
-                        rec_kids_search(kid)
-
-        rec_kids_search(root)
+        for node in parent_nodes:
+            if not node[CHILDREN]:
+                del node[CHILDREN]
 
     # print(values)
     tree = Tree.from_dict(values)
     if destination:
-        json.dump(tree.dumps(), open(destination, "w", encoding="utf-8"))
+        with open(destination, "wb") as fout:
+            fout.write(orjson.dumps(tree.dumps(), option=ORJSON_DUMP_OPTION))
     return tree
 
 
@@ -366,31 +380,60 @@ def tree_aspect_values(nodes, include_icon: Optional[bool] = True) -> List[Dict[
     return result
 
 
-def find_by(tree, value_text, use_value=True, use_text=True) -> Tuple[List[Dict[str, str]], Optional[bool]]:
-    result = {"result": [], "last_has_children": None}
-    node_found = {"found": False}
-
-    def find(node, parents, indices, **kwargs) -> Optional[bool]:
-        """
-        returns true when found
-        """
-        found_here = False
-        if kwargs["use_value"] and node["value"] == value_text:
-            kwargs["node_found"]["found"] = True
-            found_here = True
-        if kwargs["use_text"] and node["text"] == value_text:
-            kwargs["node_found"]["found"] = True
-            found_here = True
-        if found_here:
-            kwargs["result"]["result"] = tree_aspect_values(parents[1:] + [node])
-            # returning this is important to validate if the value is valid.
-            # if no allow_select_levels is not specified only leaf nodes are allowed to be selected
-            kwargs["result"]["last_has_children"] = node.get(CHILDREN, []) is not []
-            return True
-    recursive_transform(
-        tree, find, True, use_value=use_value, use_text=use_text, node_found=node_found, result=result
-    )
-    return result["result"], result["last_has_children"]
+# index for find_by: the nodes in depth first order (the root at 0), the position of their parents,
+# and the position of the first node (without the root) for each value and text
+FindIndex = Tuple[List[dict], List[int], Dict[str, int], Dict[str, int]]
+
+
+def find_by(tree, value_text, use_value=True, use_text=True,
+            index: Optional[FindIndex] = None) -> Tuple[List[Dict[str, str]], Optional[bool]]:
+    """
+    finds the first node (depth first, without the root) with the given value or text.
+    @param index: index of the tree from build_find_index, for repeated lookups. built for the call if not given
+    @return: the values of the branch down to the node and if the node has children
+    """
+    nodes, parent_pos, value_index, text_index = index or build_find_index(tree)
+    positions = []
+    if use_value and (pos := value_index.get(value_text)) is not None:
+        positions.append(pos)
+    if use_text and (pos := text_index.get(value_text)) is not None:
+        positions.append(pos)
+    if not positions:
+        return [], None
+    pos = min(positions)
+    node = nodes[pos]
+    # returning this is important to validate if the value is valid.
+    # if no allow_select_levels is not specified only leaf nodes are allowed to be selected
+    last_has_children = bool(node.get(CHILDREN))
+    branch = []
+    while pos > 0:
+        branch.append(nodes[pos])
+        pos = parent_pos[pos]
+    branch.reverse()
+    return tree_aspect_values(branch), last_has_children
+
+
+def build_find_index(tree: dict) -> FindIndex:
+    """
+    the index for find_by. it is only valid as long as the tree is not changed
+    """
+    nodes: List[dict] = []
+    parent_pos: List[int] = []
+    value_index: Dict[str, int] = {}
+    text_index: Dict[str, int] = {}
+    stack: List[Tuple[dict, int]] = [(tree, -1)]
+    while stack:
+        node, parent = stack.pop()
+        pos = len(nodes)
+        nodes.append(node)
+        parent_pos.append(parent)
+        if pos > 0:
+            value_index.setdefault(node.get(VALUE), pos)
+            text_index.setdefault(node.get(TEXT), pos)
+        children = node.get(CHILDREN)
+        if children:
+            stack.extend((child, pos) for child in reversed(children))
+    return nodes, parent_pos, value_index, text_index
 
 
 def convert_level_names_to_indices(tree: dict, levels: List[Union[int, str]]) -> List[int]:
@@ -425,16 +468,16 @@ def validate_value(tree: dict, value: List[dict], aspect: Union[AspectBaseIn, As
                 return False, "LEVEL_NOT_ALLOWED"
     current_node = tree["root"]
     for level_value in value:
-        next_node_found = False
-        for child in current_node.get(CHILDREN, []):
+        children = current_node.get(CHILDREN, [])
+        for child in children:
             if child[VALUE] == level_value[VALUE] and (not strict_language or child[TEXT] == level_value[TEXT]):
                 current_node = child
-                next_node_found = True
                 break
-        if not next_node_found:
+        else:
             if strict_language:
-                child_values = tree_aspect_values(current_node, include_icon=False)
+                child_values = tree_aspect_values(children, include_icon=False)
                 return False, f"LEVEL/TEXT DONT MATCH: {child_values}, value: {level_value}"
             else:
-                return False, f"VALUE_NOT_FOUND: {[node[VALUE] for node in current_node]}, value: {level_value}"
+                return False, f"VALUE_NOT_FOUND: {[node[VALUE] for node in children]}, value: {level_value}"
     return True, None
+